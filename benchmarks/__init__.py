@@ -0,0 +1 @@
+'''Offline benchmark suite for namectl, run with `python -m benchmarks.run`'''
@@ -0,0 +1,219 @@
+'''
+Local, in-process stand-in for the Porkbun v3 DNS API, used to benchmark namectl offline.
+
+Implements the endpoints used by `PorkbunProvider` (retrieve, retrieveByNameType, create, edit and
+delete) on top of in-memory zones, with configurable latency, error rate and rate limiting. It also
+serves `GET /ip`, which answers like an IP echo service.
+'''
+import json
+import time
+import random
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+API_PREFIX = '/api/json/v3/dns/'
+
+class FakePorkbun:
+    def __init__(
+        self,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        rate_limit: Optional[float] = None,
+        page_size: int = 1000,
+        apikey: str = 'pk1_bench',
+        secretapikey: str = 'sk1_bench',
+        ip: str = '198.51.100.7',
+        seed: int = 0,
+    ) -> None:
+        self.latency = latency
+        '''Seconds every API call takes to respond'''
+
+        self.error_rate = error_rate
+        '''Fraction of API calls that fail with HTTP 500'''
+
+        self.rate_limit = rate_limit
+        '''API calls per second allowed before calls are rejected as rate limited, if set'''
+
+        self.page_size = page_size
+        '''Records returned per page when listing a domain, starting from the 1-based `start` offset'''
+
+        self.apikey = apikey
+        self.secretapikey = secretapikey
+        self.ip = ip
+
+        self.zones: dict[str, dict[str, dict]] = {}
+        '''Records of every domain, by record ID'''
+
+        self.calls: Counter = Counter()
+        '''How many times each endpoint was called'''
+
+        self.errors = 0
+        self.throttled = 0
+
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.next_id = 1
+        self.tokens = rate_limit or 0.0
+        self.refilled = time.monotonic()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    @property
+    def api_url(self) -> str:
+        '''The URL to use as `PorkbunProvider.api_url`'''
+        return f'{self.url}{API_PREFIX[:-1]}'
+
+    def start(self) -> 'FakePorkbun':
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-porkbun', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self) -> 'FakePorkbun':
+        return self.start()
+
+    def __exit__(self, *_) -> None:
+        self.stop()
+
+    def reset_stats(self) -> None:
+        with self.lock:
+            self.calls = Counter()
+            self.errors = 0
+            self.throttled = 0
+
+    def add_record(self, domain: str, hostname: str, type: str, content: str, ttl: int = 600, prio: Optional[int] = None) -> str:
+        '''Add a record to a zone, returning its ID'''
+        with self.lock:
+            record_id = str(self.next_id)
+            self.next_id += 1
+            self.zones.setdefault(domain, {})[record_id] = {
+                'id': record_id,
+                'name': f'{hostname}.{domain}' if hostname else domain,
+                'type': type,
+                'content': content,
+                'ttl': str(ttl),
+                'prio': None if prio is None else str(prio),
+                'notes': '',
+            }
+            return record_id
+
+    def take_token(self) -> bool:
+        if self.rate_limit is None:
+            return True
+        now = time.monotonic()
+        self.tokens = min(self.rate_limit, self.tokens + (now - self.refilled) * self.rate_limit)
+        self.refilled = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def call(self, path: str, body: dict) -> tuple[int, dict]:
+        '''Handle an API call, returning the HTTP status and response body'''
+        parts = path[len(API_PREFIX):].strip('/').split('/')
+        endpoint, args = parts[0], parts[1:]
+
+        with self.lock:
+            self.calls[endpoint] += 1
+            if not self.take_token():
+                self.throttled += 1
+                return 503, {'status': 'ERROR', 'message': 'Rate limit exceeded. Please try again later.'}
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.errors += 1
+                return 500, {'status': 'ERROR', 'message': 'Internal server error.'}
+        if body.get('apikey') != self.apikey or body.get('secretapikey') != self.secretapikey:
+            return 400, {'status': 'ERROR', 'message': 'Invalid API key.'}
+        if not args:
+            return 400, {'status': 'ERROR', 'message': 'Missing domain.'}
+
+        domain = args[0]
+        with self.lock:
+            zone = self.zones.setdefault(domain, {})
+            if endpoint == 'retrieve':
+                if len(args) > 1:
+                    records = [zone[args[1]]] if args[1] in zone else []
+                else:
+                    start = max(1, int(body.get('start') or 1))
+                    records = list(zone.values())[start - 1:start - 1 + self.page_size]
+                return 200, {'status': 'SUCCESS', 'records': records}
+
+            if endpoint == 'retrieveByNameType':
+                name = f'{args[2]}.{domain}' if len(args) > 2 else domain
+                records = [r for r in zone.values() if r['type'] == args[1] and r['name'] == name]
+                return 200, {'status': 'SUCCESS', 'records': records}
+
+            if endpoint in ('edit', 'delete') and (len(args) < 2 or args[1] not in zone):
+                return 400, {'status': 'ERROR', 'message': 'Invalid record ID.'}
+
+            if endpoint == 'delete':
+                del zone[args[1]]
+                return 200, {'status': 'SUCCESS'}
+
+        if endpoint in ('create', 'edit'):
+            hostname = body.get('name', '')
+            record = (domain, hostname, body['type'], body['content'], int(body.get('ttl', 600)),
+                      int(body['prio']) if body.get('prio') is not None else None)
+            if endpoint == 'create':
+                return 200, {'status': 'SUCCESS', 'id': self.add_record(*record)}
+
+            with self.lock:
+                zone[args[1]].update({
+                    'name': f'{hostname}.{domain}' if hostname else domain,
+                    'type': record[2],
+                    'content': record[3],
+                    'ttl': str(record[4]),
+                    'prio': None if record[5] is None else str(record[5]),
+                })
+            return 200, {'status': 'SUCCESS'}
+
+        return 404, {'status': 'ERROR', 'message': f'Unknown endpoint {endpoint}.'}
+
+    def handler(self) -> type:
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Keep-alive connections otherwise stall on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def log_message(self, *_) -> None:
+                pass
+
+            def respond(self, status: int, body: bytes, content_type: str) -> None:
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self) -> None:
+                if self.path.split('?')[0] == '/ip':
+                    self.respond(200, fake.ip.encode(), 'text/plain')
+                else:
+                    self.respond(404, b'', 'text/plain')
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError:
+                    body = {}
+
+                if fake.latency:
+                    time.sleep(fake.latency)
+                status, resp = fake.call(self.path, body)
+                self.respond(status, json.dumps(resp).encode(), 'application/json')
+
+        return Handler
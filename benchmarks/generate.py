@@ -0,0 +1,111 @@
+'''
+Generators for synthetic namectl configs and registrar zones of arbitrary size.
+'''
+import os
+import random
+from typing import Optional
+import yaml
+from benchmarks.fake_porkbun import FakePorkbun
+
+def generate_record(rng: random.Random, domain: str, index: int) -> dict:
+    '''Generate the desired state of a single record'''
+    kind = rng.random()
+    hostname = f'host{index}'
+    if kind < 0.3:
+        return {'hostname': hostname, 'type': 'A', 'answer': f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}'}
+    if kind < 0.4:
+        return {'hostname': hostname, 'type': 'AAAA', 'answer': f'2001:db8::{index:x}'}
+    if kind < 0.6:
+        return {'hostname': hostname, 'type': 'CNAME', 'answer': f'target{index}.{domain}', 'ttl': 3600}
+    if kind < 0.9:
+        # TXT records tend to pile up on a few hostnames
+        return {'hostname': f'_txt{index % 10}', 'type': 'TXT', 'answer': f'verification={rng.getrandbits(64):016x}'}
+    return {'hostname': '', 'type': 'MX', 'answer': f'mx{index}.{domain}', 'priority': 10 + index % 5}
+
+def generate_config(
+    domains: int,
+    records: int,
+    accounts: int = 1,
+    dynamic: int = 0,
+    ignored: int = 0,
+    apikey: str = 'pk1_bench',
+    secretapikey: str = 'sk1_bench',
+    seed: int = 0,
+) -> dict:
+    '''
+    Generate a namectl config with `domains` domains spread over `accounts` Porkbun accounts. Every
+    domain has `records` static records, `dynamic` dynamic A records and `ignored` ignore rules.
+    '''
+    rng = random.Random(seed)
+    config = {
+        'accounts': [{
+            'name': f'account{i}',
+            'provider': 'porkbun',
+            'credentials': {'key': {'value': apikey}, 'secret': {'value': secretapikey}},
+            'http': {'pool_size': 32},
+            'rate_limit': {'rate': 1000, 'burst': 1000},
+        } for i in range(accounts)],
+        'domains': [],
+    }
+
+    for i in range(domains):
+        name = f'bench{i}.example'
+        domain_records = [generate_record(rng, name, j) for j in range(records)]
+        domain_records += [{'hostname': f'dyn{j}', 'type': 'A', 'dynamic': True} for j in range(dynamic)]
+        config['domains'].append({
+            'name': name,
+            'account': f'account{i % accounts}',
+            'records': domain_records,
+            'ignored_records': [{'hostname': f'_ignored{j}', 'type': 'TXT'} for j in range(ignored)],
+        })
+
+    return config
+
+def seed_zones(
+    fake: FakePorkbun,
+    config: dict,
+    drift: float = 0.1,
+    orphans: float = 0.05,
+    missing: float = 0.05,
+    machine_ip: Optional[str] = None,
+    seed: int = 0,
+) -> None:
+    '''
+    Fill the zones of the fake registrar from the desired state of a config. A fraction of the
+    records is `missing`, a fraction has `drift`ed content and `orphans` adds undesired records.
+    Dynamic records get `machine_ip` as content, or a stale address if unset.
+    '''
+    rng = random.Random(seed)
+    for domain in config['domains']:
+        name = domain['name']
+        for record in domain['records']:
+            roll = rng.random()
+            if roll < missing:
+                continue
+
+            answer = record.get('answer')
+            if record.get('dynamic'):
+                answer = machine_ip or '192.0.2.1'
+            elif roll < missing + drift:
+                answer = f'{answer}-drifted'
+            fake.add_record(name, record['hostname'], record['type'], answer,
+                            record.get('ttl', 600), record.get('priority'))
+
+        for j in range(round(len(domain['records']) * orphans)):
+            fake.add_record(name, f'orphan{j}', 'TXT', f'orphan {j}')
+        for rule in domain.get('ignored_records', []):
+            fake.add_record(name, rule['hostname'], rule.get('type') or 'TXT', 'externally managed')
+
+def write_config(config: dict, path: str) -> None:
+    with open(path, 'w') as cfg_file:
+        yaml.dump(config, cfg_file, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper), sort_keys=False)
+
+def write_fragments(config: dict, directory: str) -> list[str]:
+    '''Write a config as a directory of fragments: one for the accounts and one per domain'''
+    write_config({'accounts': config['accounts']}, os.path.join(directory, 'accounts.yaml'))
+    paths = []
+    for domain in config['domains']:
+        path = os.path.join(directory, f'{domain["name"]}.yaml')
+        write_config({'domains': [domain]}, path)
+        paths.append(path)
+    return paths
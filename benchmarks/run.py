@@ -0,0 +1,531 @@
+'''
+Benchmark runner for namectl reconciliation throughput.
+
+Runs every scenario fully offline against a local fake Porkbun registrar and reports wall time, API
+call counts, p50/p99 API call latency (of the HTTP requests alone), retries, time spent waiting for
+the rate limiter and peak memory. Results can be saved as JSON and compared against a saved baseline
+to gate performance regressions:
+
+```shell
+python -m benchmarks.run --domains 200 --records 50 --json baseline.json
+python -m benchmarks.run --domains 200 --records 50 --baseline baseline.json
+```
+'''
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import tempfile
+import subprocess
+import threading
+import tracemalloc
+from dataclasses import dataclass, field, asdict
+from typing import Callable, Optional
+
+LOG = logging.getLogger('namectl')
+
+@dataclass
+class Result:
+    scenario: str
+    wall: float = 0.0
+    '''Seconds the scenario took'''
+
+    calls: int = 0
+    '''API calls made to the registrar'''
+
+    calls_by_endpoint: dict = field(default_factory=dict)
+    p50: Optional[float] = None
+    '''Median API call latency in seconds, of the HTTP request alone'''
+
+    p99: Optional[float] = None
+    '''99th percentile API call latency in seconds, of the HTTP request alone'''
+
+    retries: int = 0
+    '''API calls that were made again after failing transiently or being throttled'''
+
+    limiter_wait: float = 0.0
+    '''Total seconds API calls spent waiting for the rate limiter'''
+
+    peak_memory: Optional[float] = None
+    '''Peak traced memory in MiB'''
+
+def percentile(values: list[float], fraction: float) -> Optional[float]:
+    '''Nearest-rank percentile'''
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(fraction * len(values) + 0.5) - 1))]
+
+class CallTimer:
+    '''
+    Records the latency of every API call made through the transports of the given accounts. Only
+    the HTTP requests themselves are timed, so the latencies don't include time spent waiting for the
+    rate limiter or backing off between retries, which are recorded separately.
+    '''
+    def __init__(self) -> None:
+        self.latencies: list[float] = []
+        '''Latency of every HTTP request, including retried ones'''
+
+        self.calls = 0
+        '''Calls made through the transports, each of which may take several requests'''
+
+        self.limiters = []
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def instrument(self, accounts) -> None:
+        for account in accounts:
+            transport = account.provider.transport
+            transport.session.post = self.time(transport.session.post)
+            transport.post = self.count(transport.post)
+            if transport.limiter is not None:
+                self.limiters.append(transport.limiter)
+
+    def reset(self) -> None:
+        self.latencies = []
+        self.calls = 0
+        self.waited = self.limiter_wait()
+
+    def limiter_wait(self) -> float:
+        '''Total seconds calls spent waiting for the rate limiters'''
+        return sum(limiter.waited for limiter in self.limiters)
+
+    @property
+    def retries(self) -> int:
+        return max(0, len(self.latencies) - self.calls)
+
+    def time(self, post: Callable) -> Callable:
+        def timed_post(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return post(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                with self.lock:
+                    self.latencies.append(elapsed)
+        return timed_post
+
+    def count(self, post: Callable) -> Callable:
+        def counted_post(*args, **kwargs):
+            with self.lock:
+                self.calls += 1
+            return post(*args, **kwargs)
+        return counted_post
+
+class Scenario:
+    '''A benchmark scenario. `setup` prepares fresh state for every measured run of `run`'''
+    name = ''
+    description = ''
+
+    def __init__(self, opts: argparse.Namespace) -> None:
+        self.opts = opts
+        self.fake = None
+        self.timer = CallTimer()
+
+    def setup(self) -> None:
+        pass
+
+    def run(self) -> None:
+        raise NotImplementedError
+
+    def teardown(self) -> None:
+        if self.fake:
+            self.fake.stop()
+            self.fake = None
+
+    def measure(self, trace_memory: bool) -> Result:
+        self.setup()
+        try:
+            if self.fake:
+                self.fake.reset_stats()
+            self.timer.reset()
+            if trace_memory:
+                tracemalloc.start()
+            started = time.perf_counter()
+            self.run()
+            wall = time.perf_counter() - started
+            peak = None
+            if trace_memory:
+                peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+                tracemalloc.stop()
+
+            result = Result(self.name, wall=wall, peak_memory=peak)
+            if self.fake:
+                result.calls = sum(self.fake.calls.values())
+                result.calls_by_endpoint = dict(self.fake.calls)
+            result.p50 = percentile(self.timer.latencies, 0.5)
+            result.p99 = percentile(self.timer.latencies, 0.99)
+            result.retries = self.timer.retries
+            result.limiter_wait = self.timer.limiter_wait() - self.timer.waited
+            return result
+        finally:
+            self.teardown()
+
+class PlanScenario(Scenario):
+    name = 'plan'
+    description = 'Diff large desired and existing record sets, without any provider'
+
+    def setup(self) -> None:
+        from namectl.config import DNSRecord
+        from benchmarks.generate import generate_config
+
+        config = generate_config(self.opts.domains, self.opts.records, seed=self.opts.seed)
+        self.zones = []
+        for i, domain in enumerate(config['domains']):
+            desired = [DNSRecord(
+                hostname=r['hostname'], type=r['type'], answer=r['answer'],
+                ttl=r.get('ttl', 600), priority=r.get('priority'),
+            ) for r in domain['records']]
+            existing = [DNSRecord(
+                hostname=r.hostname, type=r.type, answer=r.answer if j % 10 else f'{r.answer}-drifted',
+                ttl=r.ttl, priority=r.priority, id=str(j),
+            ) for j, r in enumerate(reversed(desired))]
+            self.zones.append((domain['name'], desired, existing))
+
+    def run(self) -> None:
+        from namectl.plan import plan_domain_records
+        for name, desired, existing in self.zones:
+            plan_domain_records(name, desired, None, existing)
+
+class IgnoreScenario(PlanScenario):
+    name = 'ignore'
+    description = 'Diff zones where most records are externally managed and matched by many ignore rules'
+
+    def setup(self) -> None:
+        from namectl.config import DNSRecord
+        from namectl.ignore import IgnoreMatcher, IgnoreRule
+
+        super().setup()
+        rules = [IgnoreRule.from_config(rule) for rule in (
+            *({'hostname': f'_ignored{j}', 'type': 'TXT'} for j in range(200)),
+            {'suffix': '_domainkey'},
+            {'glob': '_acme-challenge.*', 'type': 'TXT'},
+            {'regex': r'cdn\d+-verify', 'type': 'CNAME'},
+        )]
+        zones = []
+        for name, desired, existing in self.zones:
+            external = []
+            for j in range(len(existing) * 3):
+                hostname = (f'_acme-challenge.host{j}', f'key{j}._domainkey', f'cdn{j}-verify', f'_ignored{j}')[j % 4]
+                record_type = 'CNAME' if j % 4 == 2 else 'TXT'
+                external.append(DNSRecord(hostname=hostname, type=record_type, answer='external', id=f'x{j}'))
+            zones.append((name, desired, IgnoreMatcher(rules), existing + external))
+        self.zones = zones
+
+    def run(self) -> None:
+        from namectl.plan import plan_domain_records
+        for name, desired, ignore, existing in self.zones:
+            plan_domain_records(name, desired, ignore, existing)
+
+class RecordsScenario(Scenario):
+    name = 'records'
+    description = 'Marshal large Porkbun listings into records, keeping every record around'
+
+    def setup(self) -> None:
+        from benchmarks.generate import generate_config
+        from namectl.providers.porkbun.provider import PorkbunProvider
+
+        config = generate_config(self.opts.domains, self.opts.records, seed=self.opts.seed)
+        self.provider = PorkbunProvider('bench')
+        self.pages = []
+        for domain in config['domains']:
+            name = domain['name']
+            self.pages.append((name, json.dumps([{
+                'id': str(100000 + j),
+                'name': f'{r["hostname"]}.{name}' if r['hostname'] else name,
+                'type': r['type'],
+                'content': r['answer'],
+                'ttl': str(r.get('ttl', 600)),
+                'prio': None if r.get('priority') is None else str(r['priority']),
+                'notes': '',
+            } for j, r in enumerate(domain['records'])])))
+        self.records = None
+
+    def run(self) -> None:
+        self.records = [list(self.provider.parse_records(name, json.loads(page))) for name, page in self.pages]
+
+    def teardown(self) -> None:
+        self.records = None
+        super().teardown()
+
+class ConfigScenario(Scenario):
+    name = 'config-cold'
+    description = 'Load and marshal a large config for the first time'
+    reload = False
+
+    def setup(self) -> None:
+        from namectl.loader import ConfigManager
+        from benchmarks.generate import generate_config, write_config
+
+        config = generate_config(self.opts.domains, self.opts.records, self.opts.accounts,
+                                 dynamic=1, ignored=2, seed=self.opts.seed)
+        handle, self.path = tempfile.mkstemp(suffix='.yaml')
+        os.close(handle)
+        write_config(config, self.path)
+        self.manager = ConfigManager(self.path)
+        if self.reload:
+            self.manager.load('198.51.100.7', '')
+
+    def run(self) -> None:
+        self.manager.load('198.51.100.7', '')
+
+    def teardown(self) -> None:
+        self.manager.close()
+        os.remove(self.path)
+
+class ConfigReloadScenario(ConfigScenario):
+    name = 'config-warm'
+    description = 'Reload an unchanged large config'
+    reload = True
+
+class ConfigFragmentScenario(Scenario):
+    name = 'config-fragment'
+    description = 'Reload a config directory with one domain fragment changed'
+
+    def setup(self) -> None:
+        from namectl.loader import ConfigManager
+        from benchmarks.generate import generate_config, write_fragments
+
+        self.config = generate_config(self.opts.domains, self.opts.records, self.opts.accounts,
+                                      dynamic=1, ignored=2, seed=self.opts.seed)
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = write_fragments(self.config, self.directory.name)
+        self.manager = ConfigManager(self.directory.name)
+        self.manager.load('198.51.100.7', '')
+        self.passes = 0
+
+    def run(self) -> None:
+        from benchmarks.generate import write_config
+
+        # Alternate the TTL of a record, so that the fragment really changes on every pass
+        self.passes += 1
+        domain = self.config['domains'][self.passes % len(self.paths)]
+        domain['records'][0]['ttl'] = 600 + self.passes % 2
+        write_config({'domains': [domain]}, self.paths[self.passes % len(self.paths)])
+        self.manager.load('198.51.100.7', '')
+
+    def teardown(self) -> None:
+        self.manager.close()
+        self.directory.cleanup()
+
+class ReconcileScenario(Scenario):
+    name = 'reconcile'
+    description = 'Reconcile every domain against zones with drifted, missing and orphaned records'
+    machine_ip = '198.51.100.7'
+    seeded_ip = None
+    passes = 0
+
+    def setup(self) -> None:
+        from namectl.loader import ConfigManager
+        from benchmarks.fake_porkbun import FakePorkbun
+        from benchmarks.generate import generate_config, seed_zones, write_config
+
+        self.fake = FakePorkbun(
+            latency=self.opts.latency,
+            error_rate=self.opts.error_rate,
+            rate_limit=self.opts.rate_limit,
+            seed=self.opts.seed,
+        ).start()
+        config = generate_config(self.opts.domains, self.opts.records, self.opts.accounts,
+                                 dynamic=1, ignored=2, seed=self.opts.seed)
+        seed_zones(self.fake, config, machine_ip=self.seeded_ip, seed=self.opts.seed)
+
+        handle, self.path = tempfile.mkstemp(suffix='.yaml')
+        os.close(handle)
+        write_config(config, self.path)
+        self.manager = ConfigManager(self.path)
+        self.domains = self.manager.load(self.seeded_ip or self.machine_ip, '')
+        for account in self.manager.accounts.values():
+            account[1].provider.api_url = self.fake.api_url
+        self.timer.instrument(account for _, account in self.manager.accounts.values())
+
+        # Bring the zones in line with the config first for scenarios measuring later passes
+        for _ in range(self.passes):
+            self.reconcile(self.domains)
+
+    def reconcile(self, domains, reconcile=None) -> None:
+        from namectl.controller import reconcile_all, reconcile_domain_records
+        reconcile_all(domains, self.opts.workers, self.opts.account_workers, reconcile or reconcile_domain_records)
+
+    def run(self) -> None:
+        self.reconcile(self.domains)
+
+    def teardown(self) -> None:
+        super().teardown()
+        self.manager.close()
+        os.remove(self.path)
+
+class SteadyScenario(ReconcileScenario):
+    name = 'steady'
+    description = 'Reconcile every domain when the zones already match the config'
+    passes = 1
+
+class DynamicScenario(ReconcileScenario):
+    name = 'dynamic'
+    description = 'Reconcile after the machine IP changed, using the dynamic record fast path'
+    seeded_ip = '192.0.2.1'
+    passes = 1
+
+    def run(self) -> None:
+        from namectl.controller import reconcile_dynamic_records
+        domains = self.manager.load(self.machine_ip, '')
+        domains = [domain for domain in domains if domain.name in self.manager.rebuilt_dynamic]
+        self.reconcile(domains, reconcile_dynamic_records)
+
+STARTUP_BOOTSTRAP = '''
+import sys, runpy
+from namectl.providers.porkbun.provider import PorkbunProvider
+PorkbunProvider.api_url = sys.argv.pop(1)
+sys.argv[0] = 'namectl'
+runpy.run_module('namectl', run_name='__main__', alter_sys=True)
+'''
+'''Runs `python -m namectl` in a fresh interpreter, pointed at the fake registrar'''
+
+class StartupScenario(Scenario):
+    name = 'startup'
+    description = 'Cold start a fresh `namectl --once` process that finds nothing to change, as run from cron'
+
+    def setup(self) -> None:
+        from benchmarks.fake_porkbun import FakePorkbun
+        from benchmarks.generate import generate_config, seed_zones, write_config
+        from namectl.controller import EXIT_CHANGED, EXIT_NOOP
+
+        self.fake = FakePorkbun(latency=self.opts.latency, seed=self.opts.seed).start()
+        config = generate_config(self.opts.domains, self.opts.records, self.opts.accounts,
+                                 dynamic=1, ignored=2, seed=self.opts.seed)
+        seed_zones(self.fake, config, seed=self.opts.seed)
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'config.yaml')
+        write_config(config, self.path)
+
+        # The first run brings the zones in line with the config and fills the state store
+        self.once(expected=(EXIT_NOOP, EXIT_CHANGED))
+
+    def once(self, expected: tuple[int, ...]) -> None:
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = {**os.environ, 'PYTHONPATH': os.pathsep.join(filter(None, [root, os.environ.get('PYTHONPATH')]))}
+        proc = subprocess.run([
+            sys.executable, '-c', STARTUP_BOOTSTRAP, self.fake.api_url,
+            '--once', '-c', self.path, '--state-file', os.path.join(self.directory.name, 'state.db'),
+            '--ip-sources', f'{self.fake.url}/ip', '-w', str(self.opts.workers),
+        ], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if proc.returncode not in expected:
+            raise RuntimeError(f'namectl --once exited with {proc.returncode}\n{proc.stderr}')
+
+    def run(self) -> None:
+        self.once(expected=(0,))
+
+    def teardown(self) -> None:
+        super().teardown()
+        self.directory.cleanup()
+
+SCENARIOS: dict[str, type] = {
+    scenario.name: scenario for scenario in (
+        PlanScenario,
+        IgnoreScenario,
+        RecordsScenario,
+        ConfigScenario,
+        ConfigReloadScenario,
+        ConfigFragmentScenario,
+        ReconcileScenario,
+        SteadyScenario,
+        DynamicScenario,
+        StartupScenario,
+    )
+}
+
+def format_seconds(value: Optional[float]) -> str:
+    if value is None:
+        return '-'
+    if value < 1:
+        return f'{value * 1000:.1f}ms'
+    return f'{value:.2f}s'
+
+def report(results: list[Result]) -> str:
+    header = ['scenario', 'wall', 'calls', 'p50', 'p99', 'retries', 'limiter wait', 'peak mem']
+    rows = [[
+        result.scenario,
+        format_seconds(result.wall),
+        str(result.calls),
+        format_seconds(result.p50),
+        format_seconds(result.p99),
+        str(result.retries),
+        format_seconds(result.limiter_wait),
+        '-' if result.peak_memory is None else f'{result.peak_memory:.1f}MiB',
+    ] for result in results]
+    widths = [max(len(row[i]) for row in [header] + rows) for i in range(len(header))]
+    lines = ['  '.join(cell.ljust(width) for cell, width in zip(row, widths)) for row in [header] + rows]
+    lines.insert(1, '  '.join('-' * width for width in widths))
+    return '\n'.join(lines)
+
+def compare(results: list[Result], baseline: dict, tolerance: float) -> list[str]:
+    '''Get the regressions of the results compared to a baseline'''
+    regressions = []
+    for result in results:
+        base = baseline.get(result.scenario)
+        if base is None:
+            continue
+        if result.wall > base['wall'] * (1 + tolerance):
+            regressions.append(f'{result.scenario}: wall time {format_seconds(result.wall)} '
+                               f'vs {format_seconds(base["wall"])} in the baseline')
+        if result.calls > base['calls']:
+            regressions.append(f'{result.scenario}: {result.calls} API calls vs {base["calls"]} in the baseline')
+        if result.peak_memory and base.get('peak_memory') and \
+           result.peak_memory > base['peak_memory'] * (1 + tolerance):
+            regressions.append(f'{result.scenario}: peak memory {result.peak_memory:.1f}MiB '
+                               f'vs {base["peak_memory"]:.1f}MiB in the baseline')
+    return regressions
+
+def main(argv: list[str] = None) -> int:
+    argparser = argparse.ArgumentParser('benchmarks.run', description=__doc__.split('\n\n')[0].strip())
+    argparser.add_argument('scenarios', nargs='*', help=f'Scenarios to run, out of {", ".join(SCENARIOS)}. Defaults to all')
+    argparser.add_argument('--domains', type=int, default=100, help='Number of domains')
+    argparser.add_argument('--records', type=int, default=50, help='Number of records per domain')
+    argparser.add_argument('--accounts', type=int, default=2, help='Number of accounts the domains are spread over')
+    argparser.add_argument('-w', '--workers', type=int, default=8, help='How many domains to reconcile concurrently')
+    argparser.add_argument('--account-workers', type=int, default=None, help='How many domains of an account to reconcile concurrently')
+    argparser.add_argument('--latency', type=float, default=0.002, help='Seconds every fake registrar call takes')
+    argparser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of fake registrar calls that fail')
+    argparser.add_argument('--rate-limit', type=float, default=None, help='Calls per second the fake registrar allows')
+    argparser.add_argument('--seed', type=int, default=0, help='Seed for the generated configs and zones')
+    argparser.add_argument('--no-memory', action='store_true', help='Skip the (slower) peak memory measurement')
+    argparser.add_argument('--json', type=str, default=None, help='Write the results as JSON to this file')
+    argparser.add_argument('--baseline', type=str, default=None, help='Compare against results saved with --json')
+    argparser.add_argument('--tolerance', type=float, default=0.25, help='Allowed relative slowdown against the baseline')
+    opts = argparser.parse_args(argv)
+
+    unknown = [name for name in opts.scenarios if name not in SCENARIOS]
+    if unknown:
+        argparser.error(f'Unknown scenario(s): {", ".join(unknown)}')
+
+    # Per-record reconciliation logging would drown out the results
+    LOG.setLevel(logging.WARNING)
+
+    results = []
+    for name in opts.scenarios or SCENARIOS:
+        scenario = SCENARIOS[name](opts)
+        print(f'Running {name}: {scenario.description}', file=sys.stderr)
+        result = scenario.measure(trace_memory=False)
+        if not opts.no_memory:
+            result.peak_memory = scenario.measure(trace_memory=True).peak_memory
+        results.append(result)
+
+    print(report(results))
+
+    if opts.json:
+        with open(opts.json, 'w') as json_file:
+            json.dump({result.scenario: asdict(result) for result in results}, json_file, indent=2)
+
+    if opts.baseline:
+        with open(opts.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), opts.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,10 +1,83 @@
+import sys
+import logging
 import argparse
-from namectl.controller import controller_loop
 
-if __name__ == '__main__':
+def main() -> int:
     argparser = argparse.ArgumentParser('namectl')
+    argparser.add_argument('command', nargs='?', choices=('run', 'plan', 'apply'), default='run',
+                           help='run (the default) keeps reconciling. plan prints the changes every domain needs '
+                                'as JSON without applying them, or saves them to PLAN_FILE. '
+                                'apply applies the changes saved in PLAN_FILE')
+    argparser.add_argument('plan_file', nargs='?', default=None, metavar='PLAN_FILE',
+                           help='Where plan saves the plan to, and where apply reads it from')
     argparser.add_argument('-c', '--config', type=str, help='Path to DNS config', required=True)
-    argparser.add_argument('-p', '--loop-period', type=int, help='How often attempt record reconciliation', default=300)
+    argparser.add_argument('--once', action='store_true',
+                           help='Reconcile every domain once and exit, with status 0 if nothing changed, '
+                                '3 if records were changed and 1 if any domain failed')
+    argparser.add_argument('-p', '--loop-period', type=int, default=300,
+                           help='How often to resync each domain, unless set with accounts[].interval or domains[].interval')
+    argparser.add_argument('--ip-check-period', type=int, default=60,
+                           help='How often to check whether the machine IP changed. 0 disables checking between resyncs')
+    argparser.add_argument('--ip-sources', type=str, default='ipify',
+                           help='Comma separated list of sources to discover the machine IP from, tried in order. '
+                                'One of ipify, icanhazip, identme, interface or the URL of an echo service')
+    argparser.add_argument('--ip-timeout', type=float, default=3.0,
+                           help='How long to wait for the machine IP to be discovered')
+    argparser.add_argument('--ip-cache-ttl', type=float, default=30.0,
+                           help='How long a discovered machine IP is reused before discovering it again')
+    argparser.add_argument('--debounce', type=float, default=2.0,
+                           help='How long to wait for a burst of changes to settle before reconciling')
+    argparser.add_argument('-w', '--workers', type=int, help='How many domains to reconcile concurrently', default=1)
+    argparser.add_argument('--account-workers', type=int, default=None,
+                           help='How many domains of the same account to reconcile concurrently. '
+                                'Can be overridden per account with accounts[].concurrency')
+    argparser.add_argument('--cycle-timeout', type=float, default=None,
+                           help='Time budget of a reconciliation in seconds. Domains that could not be '
+                                'started in time are deferred to the next reconciliation')
+    argparser.add_argument('--domain-timeout', type=float, default=None,
+                           help='Time budget for reconciling a single domain in seconds')
+    argparser.add_argument('--state-file', type=str, default=None,
+                           help='Path to a file to keep the last known state of every domain in, '
+                                'so that unchanged domains are not listed on every resync')
+    argparser.add_argument('--verify-interval', type=float, default=3600,
+                           help='How often to list the records of a domain to verify its stored state')
+    argparser.add_argument('--lease-file', type=str, default=None,
+                           help='Path to a SQLite file shared by several namectl instances to split the domains '
+                                'between them. Every domain is reconciled by a single instance at a time')
+    argparser.add_argument('--instance-id', type=str, default=None,
+                           help='Unique name of this instance when sharding. Defaults to the hostname and PID')
+    argparser.add_argument('--lease-ttl', type=float, default=30.0,
+                           help='How long the leases of an instance outlive it, bounding how long it takes '
+                                'for its domains to fail over to other instances')
+    argparser.add_argument('--metrics-port', type=int, default=None,
+                           help='Serve Prometheus metrics on this port. Metrics are disabled if unset')
+    argparser.add_argument('--metrics-address', type=str, default='',
+                           help='Address to serve metrics on. Defaults to all interfaces')
     args = argparser.parse_args()
+    if args.command == 'apply' and not args.plan_file:
+        argparser.error('apply requires the PLAN_FILE saved by plan')
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(name)s - %(message)s'
+    )
+
+    # Imported only now, so that e.g. --help doesn't pay for importing everything
+    from namectl.controller import Controller
+    if args.metrics_port is not None:
+        from namectl.metrics import start_server
+        start_server(args.metrics_port, args.metrics_address)
 
-    controller_loop(args)
+    controller = Controller(args)
+    if args.command != 'run':
+        from namectl.planfile import apply_command, plan_command
+        if args.command == 'plan':
+            return plan_command(controller, args.plan_file)
+        return apply_command(controller, args.plan_file)
+    if args.once:
+        return controller.once()
+    controller.run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
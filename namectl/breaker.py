@@ -0,0 +1,120 @@
+import time
+import logging
+import threading
+from dataclasses import dataclass, fields
+
+LOG = logging.getLogger('namectl')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+'''Numeric value of every breaker state, as exposed in metrics'''
+
+@dataclass
+class BreakerConfig:
+    '''
+    Configuration for the circuit breaker of an account, read from `accounts[].circuit_breaker`.
+
+    ```yaml
+    circuit_breaker:
+      failures: 5        # consecutive failed domains after which the breaker opens
+      cooldown: 60       # seconds the domains of the account are skipped for once the breaker opens
+      max_cooldown: 900  # upper bound in seconds on the cooldown, which doubles with every failed probe
+    ```
+    '''
+    failures: int = 5
+    cooldown: float = 60.0
+    max_cooldown: float = 900.0
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'BreakerConfig':
+        '''Read the circuit breaker configuration from the `circuit_breaker` key of an account'''
+        known = {f.name: f.type for f in fields(cls)}
+        for key, value in config.items():
+            if key not in known:
+                raise ValueError(f'Unknown circuit breaker option "{key}"')
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(f'Circuit breaker option "{key}" must be a positive number, got "{value}"')
+            if known[key] is int and not isinstance(value, int):
+                raise ValueError(f'Circuit breaker option "{key}" must be an integer, got "{value}"')
+        return cls(**config)
+
+class CircuitBreaker:
+    '''
+    Circuit breaker failing fast on an account that keeps failing.
+
+    After `failures` domains of the account failed in a row, the breaker opens and the domains of
+    the account are skipped for a cooldown. Once the cooldown is over the breaker is half-open and
+    lets a single domain through as a probe. If the probe succeeds the breaker closes again,
+    otherwise it opens again for twice as long, up to `max_cooldown`.
+    '''
+    def __init__(self, account_name: str, config: BreakerConfig = None) -> None:
+        self.account_name = account_name
+        self.config = config or BreakerConfig()
+        self.lock = threading.Lock()
+
+        self.state = CLOSED
+        self.failures = 0
+        '''Consecutive failures since the last success'''
+
+        self.cooldown = self.config.cooldown
+        self.opened_until = 0.0
+        self.probing = False
+
+        self.skipped = 0
+        '''How many domains were skipped because the breaker was open'''
+
+    def allow(self) -> bool:
+        '''Whether or not a domain of the account may be reconciled now'''
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() >= self.opened_until:
+                self.state = HALF_OPEN
+                self.probing = False
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                LOG.info(f'Circuit breaker for account {self.account_name} is half-open, probing with a single domain')
+                return True
+            self.skipped += 1
+            return False
+
+    def remaining(self) -> float:
+        '''Seconds until the breaker lets a probe through'''
+        with self.lock:
+            return max(0.0, self.opened_until - time.monotonic()) if self.state == OPEN else 0.0
+
+    def record_success(self) -> None:
+        with self.lock:
+            recovered = self.state != CLOSED
+            self.state = CLOSED
+            self.failures = 0
+            self.probing = False
+            self.cooldown = self.config.cooldown
+        if recovered:
+            LOG.info(f'Circuit breaker for account {self.account_name} closed, resuming reconciliation')
+
+    def release(self) -> None:
+        '''
+        Report that a domain that was let through ended without calling the registrar, e.g. because
+        it was already up to date. This says nothing about the account, so a probe is given back.
+        '''
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.probing = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                self.cooldown = min(self.config.max_cooldown, self.cooldown * 2)
+            elif self.state == OPEN or self.failures < self.config.failures:
+                return
+            self.state = OPEN
+            self.probing = False
+            self.opened_until = time.monotonic() + self.cooldown
+            failures, cooldown = self.failures, self.cooldown
+        LOG.warning(f'Circuit breaker for account {self.account_name} opened after {failures} consecutive '
+                    f'failure(s), skipping its domains for {cooldown:.0f}s')
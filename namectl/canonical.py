@@ -0,0 +1,90 @@
+import re
+import ipaddress
+from dataclasses import replace
+from functools import lru_cache
+from typing import Callable, Optional
+from namectl.config import DNSRecord
+
+NAME_TYPES = {'CNAME', 'ALIAS', 'ANAME', 'DNAME', 'NS', 'PTR', 'MX'}
+'''Record types whose answer is a single domain name'''
+
+TXT_CHUNKS = re.compile(r'\s*"((?:[^"\\]|\\.)*)"')
+
+def canonical_name(name: str) -> str:
+    '''Domain names are case insensitive, and a trailing dot only marks them as fully qualified'''
+    return name.lower().rstrip('.') if name != '.' else name
+
+def canonical_ip(answer: str) -> str:
+    try:
+        return str(ipaddress.ip_address(answer.strip()))
+    except ValueError:
+        return answer
+
+def canonical_txt(answer: str) -> str:
+    '''
+    TXT content may be given as one or more quoted strings, which are concatenated.
+    Unquoted content is taken as is.
+    '''
+    stripped = answer.strip()
+    if not stripped.startswith('"'):
+        return answer
+
+    chunks = []
+    end = 0
+    for match in TXT_CHUNKS.finditer(stripped):
+        if match.start() != end:
+            return answer
+        chunks.append(re.sub(r'\\(.)', r'\1', match.group(1)))
+        end = match.end()
+    if end != len(stripped):
+        return answer
+    return ''.join(chunks)
+
+def canonical_srv(answer: str) -> str:
+    '''SRV content is "weight port target", where the target is a domain name'''
+    parts = answer.split()
+    if len(parts) != 3:
+        return answer
+    return f'{parts[0]} {parts[1]} {canonical_name(parts[2])}'
+
+def canonical_caa(answer: str) -> str:
+    '''CAA content is "flags tag value", where the tag is case insensitive'''
+    parts = answer.split(maxsplit=2)
+    if len(parts) != 3:
+        return answer
+    return f'{parts[0]} {parts[1].lower()} {parts[2]}'
+
+CANONICALIZERS: dict[str, Callable[[str], str]] = {
+    'A': canonical_ip,
+    'AAAA': canonical_ip,
+    'TXT': canonical_txt,
+    'SRV': canonical_srv,
+    'CAA': canonical_caa,
+    **{record_type: canonical_name for record_type in NAME_TYPES},
+}
+'''Functions bringing the answer of each type of record into canonical form'''
+
+@lru_cache(maxsize=1 << 16)
+def canonical_answer(type: str, answer: Optional[str]) -> Optional[str]:
+    '''Bring the answer of a record into canonical form. Cached, as the same answers recur every cycle'''
+    if answer is None:
+        return None
+    canonicalizer = CANONICALIZERS.get(type)
+    return canonicalizer(answer) if canonicalizer else answer
+
+@lru_cache(maxsize=1 << 16)
+def canonical_hostname(hostname: str) -> str:
+    return hostname.lower().rstrip('.')
+
+def canonicalize(record: DNSRecord, min_ttl: int = 0) -> DNSRecord:
+    '''
+    Bring a record into canonical form, so that records that only differ in representation compare
+    equal. TTLs below `min_ttl` are raised to it. Returns the record itself if it is already canonical.
+    '''
+    record_type = record.type.upper()
+    hostname = canonical_hostname(record.hostname)
+    answer = canonical_answer(record_type, record.answer)
+    ttl = max(record.ttl, min_ttl)
+    if record_type == record.type and hostname == record.hostname and answer == record.answer and ttl == record.ttl:
+        return record
+    return replace(record, hostname=hostname, type=record_type, answer=answer, ttl=ttl)
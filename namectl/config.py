@@ -1,10 +1,13 @@
-from typing import Optional, Any, TYPE_CHECKING
+import sys
+from typing import Optional, TYPE_CHECKING
 from dataclasses import dataclass
 
 if TYPE_CHECKING:
+    from namectl.breaker import CircuitBreaker
+    from namectl.ignore import IgnoreMatcher, IgnoreRule
     from namectl.providers import DNSProvider
 
-@dataclass
+@dataclass(slots=True)
 class Account:
     name: str
     '''The name for this account'''
@@ -12,8 +15,29 @@ class Account:
     provider: 'DNSProvider' = None
     '''The DNS registrar provider to use when reconciling records for this domain'''
 
-@dataclass
+    concurrency: Optional[int] = None
+    '''
+    Maximum number of domains using this account that may be reconciled at the same time.
+    If unset, the controller-wide per-account limit is used.
+    '''
+
+    interval: Optional[float] = None
+    '''
+    Seconds between periodic resyncs of the domains using this account, unless a domain sets its own.
+    If unset, the controller-wide loop period is used.
+    '''
+
+    breaker: 'CircuitBreaker' = None
+    '''Circuit breaker that skips the domains of this account while the account keeps failing'''
+
+@dataclass(frozen=True, slots=True)
 class DNSRecord:
+    '''
+    A single DNS record, either desired or existing at the registrar.
+
+    Records are immutable and hashable value objects. Hostnames and types repeat across many records,
+    so they are interned to share a single string between all records.
+    '''
     hostname: str
     '''Host name/subdomain for this record'''
 
@@ -21,10 +45,7 @@ class DNSRecord:
     '''The type of record'''
 
     answer: Optional[str]
-    '''
-    The answer/content of the DNS record.
-    Can be `None` until populated if this is a desired record with `dynamic = True`.
-    '''
+    '''The answer/content of the DNS record'''
 
     ttl: int = 600
     '''TTL of the DNS record'''
@@ -38,14 +59,16 @@ class DNSRecord:
     If true, this record will be dynamically updated with the host machine's IP address
     '''
 
-    reconciled: bool = False
-    '''Whether or not this record has been reconciled with desired state'''
+    id: Optional[str] = None
+    '''Only set for existing records. The ID the DNS provider uses to refer to this record'''
 
-    data: Any = None
-    '''Arbitrary additional data related to the record, as set by the DNS provider'''
+    def __post_init__(self) -> None:
+        if isinstance(self.hostname, str):
+            object.__setattr__(self, 'hostname', sys.intern(self.hostname))
+        if isinstance(self.type, str):
+            object.__setattr__(self, 'type', sys.intern(self.type))
 
-
-@dataclass
+@dataclass(slots=True)
 class DomainConfig:
     name: str
     '''The name of the domain this config is for'''
@@ -53,8 +76,14 @@ class DomainConfig:
     records: list[DNSRecord]
     '''A list of desired records for this domain'''
 
-    ignored_records: list[DNSRecord]
-    '''A list of records that should be ignored, i.e. left out of the reconciliation loop'''
+    ignored_records: list['IgnoreRule']
+    '''Rules for existing records that should be ignored, i.e. left out of the reconciliation loop'''
+
+    ignore: 'IgnoreMatcher' = None
+    '''The ignore rules compiled into a single matcher'''
 
     account: Account = None
     '''The account to use when reconciling records for this domain'''
+
+    interval: Optional[float] = None
+    '''Seconds between periodic resyncs of this domain. If unset, the interval of the account is used'''
@@ -1,262 +1,438 @@
-import os
 import time
 import logging
-import yaml
-from namectl.config import Account, DomainConfig, DNSRecord
-from namectl.providers import ALL_PROVIDERS
-from namectl.ping import ping4, ping6
+import threading
+from typing import Callable, Iterable, Optional
+from namectl import metrics
+from namectl.breaker import STATE_VALUES
+from namectl.config import DNSRecord, DomainConfig
+from namectl.deadline import DeadlineExceeded, deadline
+from namectl.events import TriggerQueue, watch_file, watch_ips, watch_signal, IP_CHANGED, RESYNC, SIGNALLED
+from namectl.loader import ConfigManager
+from namectl.schedule import Scheduler
+from namectl.sharding import Shard, SQLiteLeaseBackend, watch_leases
+from namectl.ping import IPDiscovery, make_source
+from namectl.plan import ChangeResult, DomainPlan, plan_domain_records, apply_plan
+from namectl.providers.transport import is_registrar_failure
+from namectl.state import DomainState, StateStore, applied_records, desired_fingerprint
+from namectl.workers import domain_logger, reconcile_concurrently
 
 LOG = logging.getLogger('namectl')
 
+EXIT_NOOP = 0
+'''Exit code of a single reconciliation that found nothing to change'''
+
+EXIT_FAILED = 1
+'''Exit code of a single reconciliation that could not reconcile some (or all) domains'''
+
+EXIT_CHANGED = 3
+'''
+Exit code of a single reconciliation that changed records, and reconciled every domain.
+Not 2, which is what argparse exits with on invalid arguments
+'''
+
 def read_dns_config(config_path: str, machine_ipv4: str, machine_ipv6: str) -> list[DomainConfig]:
     '''
     Reads the DNS configuration file used for the desired state and marshals it into a list of
-    DomainConfigs
+    DomainConfigs. Use a `ConfigManager` to avoid re-reading the configuration when it hasn't changed.
     '''
-    if not os.path.exists(config_path):
-        LOG.warning(f'The configuration file {config_path} does not exist!')
-        return []
-
-    LOG.info(f'Reading DNS configuration from {config_path}')
-    with open(config_path, 'r') as cfg_file:
-        config = yaml.load(cfg_file, yaml.Loader)
-
-    if 'accounts' not in config:
-        LOG.warning('The DNS config file is missing account configuration!')
-        return []
-
-    # Deal with reading account config and setting those up first
-    all_accounts = {}
-    for account in config['accounts']:
-        # Check for account misconfiguration
-        if 'name' not in account:
-            LOG.warning(f'Misconfigured account detected. '
-                        'An account is missing a name and will not be created!')
-            continue
-        name = account['name']
-
-        if 'provider' not in account:
-            LOG.warning(f'Misconfigured account detected. '
-                        f'The account {name} has not set the provider and will not be created!')
-            continue
-
-        # Setup the account provider
-        account_provider = ALL_PROVIDERS[account['provider']](name)
-        try:
-            account_provider.authenticate(account.get('credentials', {}))
-        except Exception as E:
-            LOG.warning(f'Failed to configure credentials for account {name}. '
-                        f'This account will not be created!\n{E}')
-            continue
-
-        all_accounts[name] = Account(name=name, provider=account_provider)
-        LOG.info(f'Registered account {name} with provider {account["provider"]}')
-
-    if 'domains' not in config:
-        LOG.warning('The DNS config file is missing domain configuration!')
-        return []
-
-    domain_configs = []
-    for domain in config['domains']:
-        # Check for misconfiguration of the domain
-        if 'name' not in domain:
-            LOG.warning(f'Misconfigured domain detected. '
-                        'A domain is missing a name and will not be reconciled!')
-            continue
-        name = domain['name']
-
-        if 'account' not in domain:
-            LOG.warning(f'Misconfigured domain detected. '
-                        f'The domain {name} has not set the account and will not be reconciled!')
-            continue
-        if domain['account'] not in all_accounts:
-            LOG.warning(f'Misconfigured domain detected. '
-                        f'The domain {name} is using the non-existent account {domain["account"]} '
-                        'and will not be reconciled!')
-            continue
-
-        if 'records' not in domain:
-            LOG.warning(f'Misconfigured domain detected. '
-                        f'The domain {name} has no records and will not be reconciled!')
-            continue
-
-        # Now read the desired records for this domain
-        records = []
-        for record in domain['records']:
-            # Check for misconfiguration of the record
-            if 'type' not in record:
-                LOG.warning(f'Misconfigured record detected. '
-                            f'A record for {name} has not set type and will not be reconciled!')
-                continue
+    return ConfigManager(config_path).load(machine_ipv4, machine_ipv6)
 
-            # If this is a dynamic record, use the machine's detected IP
-            dynamic_record = record.get('dynamic', False)
-            dynamic_answer = machine_ipv6 if record['type'] == 'AAAA' else machine_ipv4
-            if dynamic_record and dynamic_answer == '':
-                LOG.warning('Could not find machine IP for dynamic record. '
-                            f'{record.get("type")} {record.get("hostname", "")}.{name} will not be reconciled!')
-                continue
+def plan_desired_records(
+    domain: 'DomainConfig',
+    desired_records: list[DNSRecord],
+    existing_records: Iterable[DNSRecord],
+) -> DomainPlan:
+    '''
+    Plan the changes needed to bring the existing records in line with the desired records.
 
-            if not dynamic_record and 'answer' not in record:
-                LOG.warning(f'Misconfigured record detected. '
-                            f'A record for {name} has not set answer and will not be reconciled!')
-                continue
+    Both desired and existing records are brought into the canonical form of the provider first, so
+    that records only differing in representation are left alone.
+    '''
+    canonicalize = domain.account.provider.canonicalize
+    return plan_domain_records(
+        domain.name,
+        [canonicalize(record) for record in desired_records],
+        domain.ignore,
+        map(canonicalize, existing_records),
+    )
+
+def apply_desired_records(
+    domain: 'DomainConfig',
+    desired_records: list[DNSRecord],
+    existing_records: Iterable[DNSRecord],
+    log,
+    state: StateStore = None,
+    verified: float = None,
+) -> list[ChangeResult]:
+    '''
+    Plan and apply the changes needed to bring the existing records in line with the desired records.
+    If a state store is given, the domain is dropped from it before anything is changed. If `verified`
+    is also given, the resulting records are stored once every change has succeeded. Returns the
+    changes that were applied.
+    '''
+    plan = plan_desired_records(domain, desired_records, existing_records)
+    for record in plan.ignores:
+        log.debug(f'Found record {record.type} {record.hostname}.{domain.name} that will be ignored')
+    if plan.ignores:
+        log.info(f'Ignoring {len(plan.ignores)} record(s) matching the ignore rules of {domain.name}')
+
+    if state is not None and not plan.empty:
+        state.invalidate(domain.name)
+    results = apply_plan(domain.account.provider, plan, log)
+
+    if state is not None and verified is not None:
+        records = applied_records(plan, results)
+        if records is not None:
+            state.save(domain, records, verified)
+    return results
+
+def reconcile_domain_records(domain: 'DomainConfig', state: StateStore = None) -> list[ChangeResult]:
+    log = domain_logger(domain.name)
+    log.info(f'Reconciling DNS records for domain: {domain.name}')
+
+    verified = time.time()
+    existing_records = domain.account.provider.list(domain.name)
+    return apply_desired_records(domain, domain.records, existing_records, log, state, verified)
 
-            # Marshal the record configuration
-            records.append(DNSRecord(
-                hostname=record.get('hostname', ''),
-                type=record['type'],
-                answer=(dynamic_answer if dynamic_record else record.get('answer', '')),
-                ttl=record.get('ttl', 600),
-                priority=record.get('priority'),
-                dynamic=dynamic_record,
-            ))
-        
-        # Then get the list of *ignored* records
-        ignored_records = []
-        for record in domain.get('ignored_records', []):
-            if 'hostname' not in record:
-                LOG.warning(f'Misconfigured ignore record detected. '
-                            f'An ignore record for {name} has not set hostname and will not be ignored!')
-                continue
+def reconcile_stored_records(domain: 'DomainConfig', state: StateStore, stored: DomainState) -> list[ChangeResult]:
+    '''
+    Reconcile a domain against its records as kept in the state store, instead of listing them.
+    Only safe while the stored records are fresh.
+    '''
+    log = domain_logger(domain.name)
+    log.info(f'Reconciling DNS records for domain: {domain.name} (using stored state)')
+    return apply_desired_records(domain, domain.records, stored.records, log, state, stored.verified)
 
-            ignored_records.append(DNSRecord(
-                hostname=record['hostname'],
-                type=record.get('type', ''),
-                answer='',
-            ))
+def reconcile_dynamic_records(domain: 'DomainConfig', state: StateStore = None) -> list[ChangeResult]:
+    '''
+    Reconcile only the dynamic records of a domain, e.g. after the machine IP changed.
 
-        domain_configs.append(DomainConfig(
-            name=name,
-            records=records,
-            ignored_records=ignored_records,
-            account=all_accounts[domain['account']],
-        ))
-        ignore_info = f' and {len(ignored_records)} ignored record(s)' if len(ignored_records) else ''
-        LOG.info(f'Registered domain {name} with {len(records)} record(s){ignore_info} using account {domain["account"]}')
+    Only the existing records sharing a type and hostname with a dynamic record are retrieved, instead
+    of the whole domain. Since records are only ever matched within the same type and hostname, this
+    gives the same result for those records as a full reconciliation. Falls back to a full
+    reconciliation if the provider can't retrieve records by type and hostname.
+    '''
+    provider = domain.account.provider
+    if not provider.can_list_by_name_type():
+        return reconcile_domain_records(domain, state)
+
+    log = domain_logger(domain.name)
+    log.info(f'Reconciling dynamic DNS records for domain: {domain.name}')
+
+    keys = dict.fromkeys((record.type, record.hostname) for record in domain.records if record.dynamic)
+    existing_records = []
+    for record_type, hostname in keys:
+        existing_records.extend(provider.list_by_name_type(domain.name, record_type, hostname))
+
+    # Only part of the domain is listed, so the outcome can't be stored
+    desired_records = [record for record in domain.records if (record.type, record.hostname) in keys]
+    return apply_desired_records(domain, desired_records, existing_records, log, state)
+
+def reconcile_all(
+    domains: list[DomainConfig],
+    workers: int = 1,
+    account_workers: int = None,
+    reconcile: Callable[[DomainConfig], None] = reconcile_domain_records,
+) -> dict[str, Exception]:
+    '''
+    Reconcile all the given domains, running up to `workers` domains concurrently and at most
+    `account_workers` domains per account at once. Returns the errors of any domains that failed.
+    '''
+    errors = reconcile_concurrently(domains, reconcile, workers, account_workers)
+    for name, error in errors.items():
+        domain_logger(name).warning(f'An error occured while reconciling records for {name}\n{error}')
 
-    return domain_configs
+    if metrics.enabled():
+        now = time.time()
+        for domain in domains:
+            if domain.name in errors:
+                metrics.inc('namectl_reconcile_errors_total', domain=domain.name, account=domain.account.name)
+            else:
+                metrics.set_gauge('namectl_last_success_timestamp_seconds', now, domain=domain.name)
+    return errors
 
-def reconcile_domain_records(domain: 'DomainConfig') -> None:
-    LOG.info(f'Reconciling DNS records for domain: {domain.name}')
+class Controller:
+    '''
+    Event-driven reconciliation controller.
 
-    existing_records = domain.account.provider.list(domain.name)
+    Reconciliation runs whenever a trigger fires: the config file changed, the machine IP changed,
+    namectl received SIGHUP or the periodic resync of some domains is due. Triggers arriving in quick
+    succession are coalesced into a single reconciliation. Config and IP changes only reconcile the
+    domains that were affected by the change, and periodic resyncs only the domains that are due.
+    Every domain is resynced on its own interval, see `Scheduler`. SIGHUP reconciles every domain.
 
-    # Filter out any ignored records
-    for ignore_record in domain.ignored_records:
-        records_to_check = filter(
-            lambda r: (not r.reconciled) and \
-                      (r.hostname == ignore_record.hostname),
-            existing_records
-        )
-        for record in records_to_check:
-            should_ignore = True
-            # If type is set, check type as well
-            if ignore_record.type != '' and ignore_record.type != record.type:
-                should_ignore = False
-
-            # Mark as reconciled early to ignore
-            if should_ignore:
-                LOG.info(f'Found record {record.type} {record.hostname}.{domain.name} that will be ignored')
-                record.reconciled = True
-
-    # For each desired record, check if we can correct an existing record to match it if there is
-    # a mismatch. Otherwise, if we find a match, there's nothing to reconcile.
-    for desired_record in domain.records:
-        # We only consider records for edit if they fulfill all these criteria:
-        # * The record hasn't already been reconciled with another desired record
-        # * The record type matches the desired record type
-        # * The record hostname matches the desired hostname
-        records_to_check = filter(
-            lambda r: (not r.reconciled) and \
-                      (r.type == desired_record.type) and \
-                      (r.hostname == desired_record.hostname),
-            existing_records
+    With a state store, domains whose desired state was already applied are skipped and changes are
+    planned against the stored records, until they are due to be verified by listing them again.
+    SIGHUP always verifies every domain.
+    '''
+    def __init__(self, args) -> None:
+        self.args = args
+        self.config = ConfigManager(args.config)
+        self.triggers = TriggerQueue(args.debounce)
+        self.ips = IPDiscovery(
+            [make_source(name) for name in args.ip_sources.split(',')],
+            timeout=args.ip_timeout,
+            cache_ttl=args.ip_cache_ttl,
         )
-
-        mismatching_record = None
-        for record in records_to_check:
-            # Check if there is a mismatch in the record content, TTL or priority (if set)
-            mismatch = False
-            if record.answer != desired_record.answer:
-                mismatch = True
-            if record.ttl != desired_record.ttl:
-                mismatch = True
-            if desired_record.priority is not None and record.priority != desired_record.priority:
-                mismatch = True
-
-            # Found a match, no need to update any records
-            if not mismatch:
-                mismatching_record = None
-                record.reconciled = True
-                desired_record.reconciled = True
-                break
-            else:
-                mismatching_record = record
-
-        # Of the records that matched the desired type and hostname,
-        # we couldn't find one with the correct config. Correct one of them.
-        if mismatching_record:
-            assert(mismatching_record is not None)
-            LOG.info(f'Mismatch detected: updating record - '
-                     f'{desired_record.type} {desired_record.hostname}.{domain.name} -> {desired_record.answer} (TTL={desired_record.ttl})')
-            domain.account.provider.update(domain.name, mismatching_record, desired_record)
-            mismatching_record.reconciled = True
-            desired_record.reconciled = True
-
-    # Find out which records are not being used anymore (orphaned) and delete them
-    orphaned_records = list(filter(
-        lambda r: not r.reconciled,
-        existing_records
-    ))
-    for record in orphaned_records:
-        LOG.info(f'Deleting orphaned record - {record.type} {record.hostname}.{domain.name} -> {record.answer}')
-        domain.account.provider.delete(domain.name, record)
-        record.reconciled = True
-
-    # Then create records for any desired records that haven't been reconciled yet
-    records_to_create = list(filter(
-        lambda r: not r.reconciled,
-        domain.records
-    ))
-    for desired_record in records_to_create:
-        LOG.info(f'Creating DNS record: {desired_record.type} {desired_record.hostname}.{domain.name} -> {desired_record.answer} (TTL={desired_record.ttl})')
-        domain.account.provider.create(domain.name, desired_record)
-        desired_record.reconciled = True
-
-def controller_loop(args):
-    LOG.info('Entering namectl controller loop')
-    while True:
-        try:
-            current_ipv4 = ping4()
-            LOG.info(f'Current IPv4 is: {current_ipv4}')
-        except:
-            LOG.warning('Failed to get IPv4, dynamic A records will not be reconciled')
-            current_ipv4 = ''
-
-        try:
-            current_ipv6 = ping6()
-            LOG.info(f'Current IPv6 is: {current_ipv6}')
-        except:
-            LOG.warning('Failed to get IPv6, dynamic AAAA records will not be reconciled')
-            current_ipv6 = ''
+        self.state = StateStore(args.state_file) if args.state_file else None
+        self.schedule = Scheduler()
+        self.shard = None
+        if args.lease_file:
+            self.shard = Shard(SQLiteLeaseBackend(args.lease_file), args.instance_id, args.lease_ttl)
+
+        self.deferred: set[str] = set()
+        '''Domains the last cycle ran out of time for, which are reconciled right away in the next cycle'''
+
+        self.changed: set[str] = set()
+        '''Domains whose records the last cycle changed'''
+
+        self.failed: set[str] = set()
+        '''Domains the last cycle failed to reconcile, skipped or deferred'''
+
+        self.config_failed = False
+        '''Whether or not the last cycle could not load a single domain from the config'''
+        metrics.register_collector(self.collect_metrics)
+
+    def collect_metrics(self):
+        '''Report the state of the circuit breaker and rate limiter of every account'''
+        for _, account in list(self.config.accounts.values()):
+            if account.breaker is not None:
+                yield 'namectl_circuit_breaker_state', {'account': account.name}, STATE_VALUES[account.breaker.state]
+                yield 'namectl_circuit_breaker_skipped_total', {'account': account.name}, account.breaker.skipped
+
+            limiter = account.provider.transport.limiter
+            if limiter is None:
+                continue
+            state = limiter.snapshot()
+            yield 'namectl_rate_limit_rate', {'account': account.name}, state['rate']
+            yield 'namectl_rate_limit_tokens', {'account': account.name}, state['tokens']
+            yield 'namectl_rate_limit_throttled_total', {'account': account.name}, state['throttled']
+            yield 'namectl_rate_limit_wait_seconds_total', {'account': account.name}, state['waited']
+
+    def reconcile(self, reasons: set[str], due: Optional[set[str]] = None) -> set[str]:
+        '''
+        Run a single reconciliation for the given trigger reasons. A resync only covers the `due`
+        domains, or every domain if unset. Returns the names of the domains that were reconciled.
+        '''
+        self.changed, self.failed, self.config_failed = set(), set(), True
+        current_ipv4, current_ipv6 = self.ips.discover()
 
         try:
-            domains = read_dns_config(args.config, current_ipv4, current_ipv6)
+            with metrics.timer('namectl_config_load_seconds'):
+                domains = self.config.load(current_ipv4, current_ipv6)
         except Exception as E:
             LOG.warning('An error occured while reading the DNS configuration. '
                         f'Reconciliation will resume when the configuration file is valid.\n{E}')
-            time.sleep(args.loop_period)
-            continue
+            return set()
 
         if not len(domains):
             LOG.warning('No domain configuration detected!')
-            continue
-
-        for domain in domains:
+            return set()
+        self.config_failed = False
+        if self.state is not None:
+            self.state.prune(domain.name for domain in domains)
+
+        # When sharding, only the domains this instance holds a lease on are scheduled and reconciled,
+        # and domains taken over from other instances are reconciled right away
+        gained = set()
+        if self.shard is not None:
+            try:
+                self.shard.refresh(domain.name for domain in domains)
+            except Exception as E:
+                LOG.warning(f'Failed to renew the leases of {self.shard.instance}\n{E}')
+            domains = [domain for domain in domains if self.shard.owns(domain.name)]
+            gained = self.shard.take_gained()
+
+        self.schedule.sync({
+            domain.name: domain.interval or domain.account.interval or self.args.loop_period
+            for domain in domains
+        })
+        if not domains:
+            LOG.info('No domains are owned by this instance')
+            return set()
+
+        # Unless everything should be reconciled, reconcile just the domains affected by a config or
+        # IP change, the domains that are due for a resync and the domains taken over from other instances
+        if not (SIGNALLED in reasons or (RESYNC in reasons and due is None)):
+            selected = self.config.rebuilt | (due or set()) | gained
+            domains = [domain for domain in domains if domain.name in selected]
+            if not domains:
+                LOG.info('No domains were affected by the change')
+                return set()
+
+        # If only the machine IP changed, domains that were only affected through their dynamic
+        # records can take the fast path, unless they are due for a resync anyway
+        fast_path = set()
+        if reasons - {RESYNC} == {IP_CHANGED}:
+            fast_path = self.config.rebuilt_dynamic - (due or set())
+        verify = SIGNALLED in reasons
+
+        # Domains that can't start before the cycle runs out of time are deferred to the next cycle,
+        # and domains of accounts whose circuit breaker is open are skipped
+        started = time.monotonic()
+        cycle_deadline = started + self.args.cycle_timeout if self.args.cycle_timeout else None
+        skipped: dict[str, list[str]] = {}
+        deferred: list[str] = []
+        changed: list[str] = []
+        lock = threading.Lock()
+
+        def reconcile(domain: DomainConfig) -> None:
+            now = time.monotonic()
+            if cycle_deadline is not None and now >= cycle_deadline:
+                with lock:
+                    deferred.append(domain.name)
+                return
+
+            breaker = domain.account.breaker
+            if breaker is not None and not breaker.allow():
+                with lock:
+                    skipped.setdefault(domain.account.name, []).append(domain.name)
+                return
+
+            domain_deadline = now + self.args.domain_timeout if self.args.domain_timeout else None
             try:
-                reconcile_domain_records(domain)
+                with deadline(cycle_deadline), deadline(domain_deadline):
+                    results = self.reconcile_owned(domain, domain.name in fast_path, verify)
             except Exception as E:
-                LOG.warning(f'An error occured while reconciling records for {domain.name}\n{E}')
-        
-        time.sleep(args.loop_period)
+                if isinstance(E, DeadlineExceeded):
+                    metrics.inc('namectl_deadline_exceeded_total', domain=domain.name, account=domain.account.name)
+                if breaker is not None:
+                    # Only failures of the registrar count against the account. A slow registrar
+                    # overrunning the domain's time budget does, the whole cycle running out of time doesn't
+                    own_deadline = domain_deadline is not None and (cycle_deadline is None or domain_deadline < cycle_deadline)
+                    if is_registrar_failure(E) or (isinstance(E, DeadlineExceeded) and own_deadline):
+                        breaker.record_failure()
+                    else:
+                        breaker.release()
+                raise
+            if breaker is not None:
+                # A domain that was skipped without calling the registrar proves nothing either way
+                if results is None:
+                    breaker.release()
+                else:
+                    breaker.record_success()
+            if results:
+                with lock:
+                    changed.append(domain.name)
+
+        errors = reconcile_all(domains, self.args.workers, self.args.account_workers, reconcile)
+
+        for account, names in skipped.items():
+            # Retry once the breaker lets a probe through, rather than at the next regular resync
+            remaining = max(1.0, self.config.accounts[account][1].breaker.remaining())
+            self.schedule.retry(set(names), remaining)
+            LOG.warning(f'Skipped {len(names)} domain(s) of account {account} while its circuit breaker is open, '
+                        f'retrying in {remaining:.0f}s')
+            metrics.inc('namectl_domains_skipped_total', len(names), account=account, reason='circuit_open')
+        if deferred:
+            LOG.warning(f'Reconciliation ran out of time after {time.monotonic() - started:.1f}s, '
+                        f'deferring {len(deferred)} domain(s) to the next cycle')
+            metrics.inc('namectl_domains_skipped_total', len(deferred), reason='cycle_deadline')
+        self.deferred = set(deferred)
+        self.changed = set(changed)
+        self.failed = self.deferred.union(errors, *skipped.values())
+
+        not_reconciled = self.deferred.union(*skipped.values())
+        return {domain.name for domain in domains if domain.name not in not_reconciled}
+
+    def reconcile_owned(self, domain: DomainConfig, dynamic_only: bool = False, verify: bool = False) -> Optional[list[ChangeResult]]:
+        '''
+        Reconcile a single domain, unless it was handed over to another instance in the meantime.
+        Returns `None` if the domain was skipped without calling the registrar, see `reconcile_domain`.
+        '''
+        if self.shard is None:
+            return self.reconcile_domain(domain, dynamic_only, verify)
+        if not self.shard.begin(domain.name):
+            domain_logger(domain.name).info(f'Skipping {domain.name}, which is no longer owned by this instance')
+            return None
+        try:
+            return self.reconcile_domain(domain, dynamic_only, verify)
+        finally:
+            self.shard.end(domain.name)
+
+    def reconcile_domain(self, domain: DomainConfig, dynamic_only: bool = False, verify: bool = False) -> Optional[list[ChangeResult]]:
+        '''
+        Reconcile a single domain, only reconciling its dynamic records if `dynamic_only` is set.
+        Unless `verify` is set, the state store is used to skip the domain or avoid listing it.
+        Returns the changes that were applied, or `None` if the domain was skipped without calling
+        the registrar.
+        '''
+        if self.state is None:
+            return reconcile_dynamic_records(domain) if dynamic_only else reconcile_domain_records(domain)
+
+        try:
+            stored = None if verify else self.state.get(domain.name)
+            if stored and stored.account == domain.account.name and stored.fresh(self.args.verify_interval):
+                if stored.desired == desired_fingerprint(domain):
+                    domain_logger(domain.name).info(
+                        f'Desired state was already applied to {domain.name}, '
+                        f'last verified {time.time() - stored.verified:.0f}s ago')
+                    return None
+                return reconcile_stored_records(domain, self.state, stored)
+
+            if dynamic_only:
+                return reconcile_dynamic_records(domain, self.state)
+            return reconcile_domain_records(domain, self.state)
+        except Exception:
+            self.state.invalidate(domain.name)
+            raise
+
+    def run(self) -> None:
+        LOG.info('Entering namectl controller loop')
+        watch_file(self.args.config, self.triggers)
+        watch_signal(self.triggers)
+        watch_ips(self.ips, self.triggers, self.args.ip_check_period)
+        if self.shard is not None:
+            LOG.info(f'Sharding domains as instance {self.shard.instance}')
+            watch_leases(self.shard, self.triggers)
+
+        try:
+            # Resync every domain on startup
+            reasons, due = {RESYNC}, None
+            while True:
+                if reasons:
+                    LOG.info(f'Reconciliation triggered by: {", ".join(sorted(reasons))}')
+                    full = SIGNALLED in reasons or (RESYNC in reasons and due is None)
+                    with metrics.timer('namectl_cycle_duration_seconds', scope='full' if full else 'partial'):
+                        reconciled = self.reconcile(reasons, due)
+                    # Domains that were just reconciled don't need a resync until their next interval
+                    self.schedule.reschedule(reconciled)
+
+                next_due = 0 if self.deferred else self.schedule.next_due()
+                reasons = self.triggers.wait(None if next_due is None else max(0, next_due - time.monotonic()))
+                due = self.schedule.pop_due() | self.deferred
+                if due:
+                    reasons.add(RESYNC)
+        finally:
+            # Hand the domains of this instance over to the other instances right away
+            if self.shard is not None:
+                self.shard.close()
+
+    def once(self) -> int:
+        '''
+        Reconcile every domain a single time, e.g. when run from cron. Returns the exit code:
+        `EXIT_NOOP` if nothing had to change, `EXIT_CHANGED` if records were changed and
+        `EXIT_FAILED` if the config could not be loaded or any domain could not be reconciled.
+        '''
+        try:
+            with metrics.timer('namectl_cycle_duration_seconds', scope='full'):
+                self.reconcile({RESYNC})
+        finally:
+            if self.shard is not None:
+                self.shard.close()
+            if self.state is not None:
+                self.state.close()
+            self.config.close()
+
+        if self.config_failed or self.failed:
+            LOG.warning(f'Failed to reconcile {len(self.failed)} domain(s)' if self.failed else
+                        'Failed to load any domain from the configuration')
+            return EXIT_FAILED
+        if self.changed:
+            LOG.info(f'Changed the records of {len(self.changed)} domain(s)')
+            return EXIT_CHANGED
+        LOG.info('All domains were already up to date')
+        return EXIT_NOOP
+
+def controller_loop(args):
+    Controller(args).run()
@@ -0,0 +1,48 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Optional
+
+class DeadlineExceeded(TimeoutError):
+    '''Raised when work runs out of its time budget'''
+
+_DEADLINE: ContextVar[Optional[float]] = ContextVar('namectl_deadline', default=None)
+'''Monotonic time by which the current work must be done, if it has a deadline'''
+
+@contextmanager
+def deadline(at: Optional[float]):
+    '''
+    Run the body with a deadline, given as a `time.monotonic()` timestamp. Nested deadlines can only
+    tighten the current one. `None` leaves the current deadline as it is.
+    '''
+    current = _DEADLINE.get()
+    if at is not None and current is not None:
+        at = min(at, current)
+    token = _DEADLINE.set(at if at is not None else current)
+    try:
+        yield
+    finally:
+        _DEADLINE.reset(token)
+
+def remaining() -> Optional[float]:
+    '''Seconds left until the current deadline, or `None` if there is none'''
+    at = _DEADLINE.get()
+    return None if at is None else at - time.monotonic()
+
+def check(what: str = 'Work') -> Optional[float]:
+    '''Raise `DeadlineExceeded` if the current deadline has passed. Returns the seconds left, if any'''
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f'{what} ran out of time')
+    return left
+
+def propagate(fn: Callable) -> Callable:
+    '''Wrap a function so that it runs with the current deadline, e.g. on another thread'''
+    at = _DEADLINE.get()
+    def with_deadline(*args, **kwargs):
+        token = _DEADLINE.set(at)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _DEADLINE.reset(token)
+    return with_deadline
@@ -0,0 +1,253 @@
+import os
+import sys
+import time
+import errno
+import struct
+import signal
+import logging
+import threading
+import ctypes
+import ctypes.util
+from typing import Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from namectl.ping import IPDiscovery
+
+LOG = logging.getLogger('namectl')
+
+CONFIG_CHANGED = 'config'
+'''Trigger fired when the DNS config file changed'''
+
+FRAGMENT_SUFFIXES = ('.yaml', '.yml')
+'''The files of a config directory that are read as config fragments'''
+
+IP_CHANGED = 'ip'
+'''Trigger fired when the machine IP changed'''
+
+SIGNALLED = 'signal'
+'''Trigger fired when namectl received SIGHUP'''
+
+RESYNC = 'resync'
+'''Trigger for the periodic full resync of all domains'''
+
+SHARD_CHANGED = 'shard'
+'''Trigger fired when this instance took ownership of domains from other instances'''
+
+class TriggerQueue:
+    '''
+    Collects the reasons to run a reconciliation from all watchers.
+
+    Bursts of triggers are debounced: once a trigger has fired, the queue waits until no new
+    triggers have arrived for `debounce` seconds (but no longer than `max_delay` seconds in total)
+    and coalesces everything that fired in the meantime into a single set of reasons.
+    '''
+    def __init__(self, debounce: float = 1.0, max_delay: float = None) -> None:
+        self.debounce = debounce
+        self.max_delay = max_delay if max_delay is not None else 5 * debounce
+        # Reentrant, as triggers may be fired from a signal handler on the waiting thread
+        self.condition = threading.Condition(threading.RLock())
+        self.reasons: set[str] = set()
+        self.first_fired = 0.0
+        self.last_fired = 0.0
+
+    def fire(self, reason: str) -> None:
+        '''Request a reconciliation for the given reason'''
+        with self.condition:
+            now = time.monotonic()
+            if not self.reasons:
+                self.first_fired = now
+            self.last_fired = now
+            self.reasons.add(reason)
+            self.condition.notify_all()
+
+    def wait(self, timeout: Optional[float] = None) -> set[str]:
+        '''
+        Block until triggers have fired and settled, or until the timeout expires.
+        Returns the set of reasons that fired, which is empty if the wait timed out.
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.reasons, timeout):
+                return set()
+
+            while True:
+                now = time.monotonic()
+                settle = min(self.last_fired + self.debounce, self.first_fired + self.max_delay)
+                if now >= settle:
+                    break
+                self.condition.wait(settle - now)
+
+            reasons, self.reasons = self.reasons, set()
+            return reasons
+
+class Watcher(threading.Thread):
+    '''Background thread that fires triggers on a `TriggerQueue`'''
+    def __init__(self, triggers: TriggerQueue, name: str) -> None:
+        super().__init__(name=name, daemon=True)
+        self.triggers = triggers
+        self.stopped = threading.Event()
+
+    def stop(self) -> None:
+        self.stopped.set()
+
+def is_fragment(name: str) -> bool:
+    '''Whether or not a file in a config directory is a config fragment'''
+    return name.endswith(FRAGMENT_SUFFIXES) and not name.startswith('.')
+
+class PollingFileWatcher(Watcher):
+    '''
+    Watches a file for changes by periodically checking its modification time, size and inode.
+    If the path is a directory, every config fragment in it is checked.
+    '''
+    def __init__(self, path: str, triggers: TriggerQueue, poll_period: float = 5.0) -> None:
+        super().__init__(triggers, 'namectl-config-poll')
+        self.path = path
+        self.poll_period = poll_period
+
+    def stat(self) -> Optional[tuple]:
+        try:
+            stat = os.stat(self.path)
+            if os.path.isdir(self.path):
+                return tuple(
+                    (entry.name, entry.stat().st_mtime_ns, entry.stat().st_size, entry.inode())
+                    for entry in sorted(os.scandir(self.path), key=lambda entry: entry.name)
+                    if is_fragment(entry.name)
+                )
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def run(self) -> None:
+        last = self.stat()
+        while not self.stopped.wait(self.poll_period):
+            current = self.stat()
+            if current != last:
+                last = current
+                LOG.debug(f'Detected a change to {self.path}')
+                self.triggers.fire(CONFIG_CHANGED)
+
+class InotifyFileWatcher(Watcher):
+    '''
+    Watches a file for changes using inotify.
+
+    The directory containing the file is watched rather than the file itself, so that editors and
+    tools that replace the file by renaming over it are caught as well. If the path is a directory,
+    it is watched itself for changes to any config fragment in it.
+    '''
+    IN_MODIFY = 0x002
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_FROM = 0x040
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_CLOEXEC = 0o2000000
+
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, path: str, triggers: TriggerQueue) -> None:
+        super().__init__(triggers, 'namectl-config-inotify')
+        self.path = path
+        self.filename = os.path.basename(path).encode()
+        self.directory = os.path.isdir(path)
+
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_FROM | \
+               self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        directory = path if self.directory else os.path.dirname(os.path.abspath(path))
+        if libc.inotify_add_watch(self.fd, directory.encode(), mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, f'inotify_add_watch failed for {directory}')
+
+    @staticmethod
+    def available() -> bool:
+        '''Whether or not inotify can be used on this system'''
+        if not sys.platform.startswith('linux'):
+            return False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'))
+            return hasattr(libc, 'inotify_init1')
+        except OSError:
+            return False
+
+    def run(self) -> None:
+        while not self.stopped.is_set():
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as E:
+                if E.errno == errno.EINTR:
+                    continue
+                if not self.stopped.is_set():
+                    LOG.warning(f'Stopped watching {self.path} for changes\n{E}')
+                return
+
+            offset = 0
+            changed = False
+            while offset < len(data):
+                _, _, _, length = self.EVENT.unpack_from(data, offset)
+                offset += self.EVENT.size
+                name = data[offset:offset + length].rstrip(b'\0')
+                offset += length
+                if self.directory:
+                    changed = changed or is_fragment(os.fsdecode(name))
+                else:
+                    changed = changed or name == self.filename
+
+            if changed:
+                LOG.debug(f'Detected a change to {self.path}')
+                self.triggers.fire(CONFIG_CHANGED)
+
+def watch_file(path: str, triggers: TriggerQueue, poll_period: float = 5.0) -> Watcher:
+    '''Start watching a file or config directory for changes, using inotify if available and polling otherwise'''
+    watcher = None
+    if InotifyFileWatcher.available():
+        try:
+            watcher = InotifyFileWatcher(path, triggers)
+        except OSError as E:
+            LOG.warning(f'Could not use inotify to watch {path}, falling back to polling\n{E}')
+    if watcher is None:
+        watcher = PollingFileWatcher(path, triggers, poll_period)
+
+    watcher.start()
+    return watcher
+
+class IPWatcher(Watcher):
+    '''
+    Periodically rediscovers the machine IPs, bypassing the discovery cache.
+    The discovery fires the trigger itself when the IPs change, see `watch_ips`.
+    '''
+    def __init__(self, discovery: 'IPDiscovery', triggers: TriggerQueue, period: float) -> None:
+        super().__init__(triggers, 'namectl-ip')
+        self.discovery = discovery
+        self.period = period
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.period):
+            self.discovery.discover(force=True)
+
+def watch_ips(discovery: 'IPDiscovery', triggers: TriggerQueue, period: float) -> Optional[IPWatcher]:
+    '''
+    Fire a trigger whenever the discovered machine IPs change, and check for changes every `period`
+    seconds. Returns the watcher, or `None` if periodic checking is disabled (`period` is 0)
+    '''
+    discovery.on_change = lambda _: triggers.fire(IP_CHANGED)
+    if period <= 0:
+        return None
+
+    watcher = IPWatcher(discovery, triggers, period)
+    watcher.start()
+    return watcher
+
+def watch_signal(triggers: TriggerQueue, signum: int = getattr(signal, 'SIGHUP', None)) -> bool:
+    '''
+    Fire a trigger whenever the given signal (SIGHUP by default) is received.
+    Returns whether the signal handler could be installed.
+    '''
+    if signum is None or threading.current_thread() is not threading.main_thread():
+        return False
+
+    signal.signal(signum, lambda *_: triggers.fire(SIGNALLED))
+    return True
@@ -0,0 +1,167 @@
+import re
+from dataclasses import dataclass
+from typing import Iterable, Optional
+from namectl.config import DNSRecord
+
+HOSTNAME = 'hostname'
+SUFFIX = 'suffix'
+GLOB = 'glob'
+REGEX = 'regex'
+
+KINDS = (HOSTNAME, SUFFIX, GLOB, REGEX)
+'''The ways an ignore rule can match hostnames, by the config key that sets them'''
+
+ANY_TYPE = '*'
+'''Stands in for every record type in the type sets of the matcher'''
+
+@dataclass(frozen=True, slots=True)
+class IgnoreRule:
+    '''
+    A rule for existing records that namectl should leave alone, read from `domains[].ignored_records`.
+    Hostnames are relative to the domain, `''` being the domain itself.
+    '''
+    kind: str
+    '''How the pattern is matched against hostnames:
+    * `hostname`: the hostname is exactly the pattern
+    * `suffix`: the hostname is the pattern or any hostname below it, e.g. `_domainkey` matches
+      `_domainkey` and `google._domainkey`
+    * `glob`: the hostname matches the pattern, `*` matching any text (including dots) and `?` any
+      single character, e.g. `_acme-challenge.*` or `*._domainkey`
+    * `regex`: the whole hostname matches the regular expression
+    '''
+
+    pattern: str
+    '''The pattern hostnames are matched against'''
+
+    types: Optional[frozenset[str]] = None
+    '''The record types the rule applies to, or `None` for every type'''
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'IgnoreRule':
+        '''Read an ignore rule from an entry of `ignored_records`. Raises `ValueError` if it is invalid'''
+        if not isinstance(config, dict):
+            raise ValueError(f'expected a mapping, got "{config}"')
+        kinds = [kind for kind in KINDS if kind in config]
+        if len(kinds) != 1:
+            raise ValueError(f'exactly one of {", ".join(KINDS)} must be set')
+        kind = kinds[0]
+
+        pattern = config[kind]
+        if not isinstance(pattern, str):
+            raise ValueError(f'{kind} must be a string, got "{pattern}"')
+        if kind == REGEX:
+            try:
+                re.compile(pattern, re.IGNORECASE)
+            except re.error as E:
+                raise ValueError(f'invalid regex "{pattern}": {E}') from None
+        else:
+            pattern = pattern.lower().rstrip('.')
+
+        types = config.get('type') or None
+        if types is not None:
+            if isinstance(types, str):
+                types = [types]
+            if not isinstance(types, list) or not all(isinstance(t, str) for t in types):
+                raise ValueError(f'type must be a string or a list of strings, got "{config["type"]}"')
+            types = frozenset(t.upper() for t in types)
+
+        return cls(kind=kind, pattern=pattern, types=types)
+
+    def key(self) -> tuple:
+        '''A JSON serializable key identifying the rule'''
+        return (self.kind, self.pattern, sorted(self.types) if self.types is not None else None)
+
+class _Node:
+    '''A node of the label trie, standing for the hostname spelled by the labels on its path'''
+    __slots__ = ('children', 'exact', 'below')
+
+    def __init__(self) -> None:
+        self.children: dict[str, _Node] = {}
+        self.exact: set[str] = set()
+        '''Types ignored on exactly this hostname'''
+
+        self.below: set[str] = set()
+        '''Types ignored on this hostname and every hostname below it'''
+
+def labels(hostname: str) -> list[str]:
+    '''The labels of a hostname, from the last one. The domain itself (`''`) has no labels'''
+    return hostname.split('.')[::-1] if hostname else []
+
+def covers(types: set[str], record_type: str) -> bool:
+    return ANY_TYPE in types or record_type in types
+
+def glob_to_regex(pattern: str) -> str:
+    return ''.join('.*' if char == '*' else '.' if char == '?' else re.escape(char) for char in pattern)
+
+class IgnoreMatcher:
+    '''
+    Matches records against all the ignore rules of a domain at once.
+
+    Exact and suffix rules are compiled into a trie of hostname labels, walked from the last label,
+    so they cost a single walk of the hostname no matter how many there are. Glob rules are combined
+    into one regex for every distinct set of types they apply to. Regex rules are compiled on their
+    own, as combining them would break their flags, group names and backreferences. Results are
+    cached by type and hostname, as the same names recur in every listing.
+    '''
+    def __init__(self, rules: Iterable[IgnoreRule] = ()) -> None:
+        self.rules = list(rules)
+        self.root = _Node()
+        self.trie_used = False
+
+        patterns: dict[Optional[frozenset[str]], list[str]] = {}
+        for rule in self.rules:
+            types = rule.types if rule.types is not None else {ANY_TYPE}
+            if rule.kind in (HOSTNAME, SUFFIX):
+                node = self.root
+                for label in labels(rule.pattern):
+                    node = node.children.setdefault(label, _Node())
+                (node.exact if rule.kind == HOSTNAME else node.below).update(types)
+                self.trie_used = True
+            elif rule.kind == GLOB:
+                patterns.setdefault(rule.types, []).append(glob_to_regex(rule.pattern))
+
+        self.regexes = [
+            (types, re.compile('|'.join(regexes), re.IGNORECASE))
+            for types, regexes in patterns.items()
+        ]
+        self.regexes.extend(
+            (rule.types, re.compile(rule.pattern, re.IGNORECASE))
+            for rule in self.rules if rule.kind == REGEX
+        )
+        self.cache: dict[tuple[str, str], bool] = {}
+
+    def __bool__(self) -> bool:
+        return bool(self.rules)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def matches(self, record: DNSRecord) -> bool:
+        '''Whether or not the record matches one of the ignore rules'''
+        if not self.rules:
+            return False
+        key = (record.type, record.hostname)
+        ignored = self.cache.get(key)
+        if ignored is None:
+            ignored = self.cache[key] = self._match(record.type, record.hostname.lower())
+            if len(self.cache) > 1 << 16:
+                self.cache.clear()
+        return ignored
+
+    def _match(self, record_type: str, hostname: str) -> bool:
+        if self.trie_used:
+            node = self.root
+            for label in labels(hostname):
+                if covers(node.below, record_type):
+                    return True
+                node = node.children.get(label)
+                if node is None:
+                    break
+            else:
+                if covers(node.exact, record_type) or covers(node.below, record_type):
+                    return True
+
+        for types, regex in self.regexes:
+            if (types is None or record_type in types) and regex.fullmatch(hostname):
+                return True
+        return False
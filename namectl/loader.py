@@ -0,0 +1,623 @@
+import os
+import hashlib
+import logging
+from dataclasses import dataclass, field
+from typing import Optional
+import yaml
+from namectl.breaker import BreakerConfig, CircuitBreaker
+from namectl.config import Account, DomainConfig, DNSRecord
+from namectl.events import is_fragment
+from namectl.ignore import IgnoreMatcher, IgnoreRule
+from namectl.providers import ALL_PROVIDERS
+from namectl.providers.ratelimit import RateLimiter, RateLimitConfig
+from namectl.providers.transport import HTTPTransport, TransportConfig
+
+LOG = logging.getLogger('namectl')
+
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+'''The YAML loader used to parse configuration. Uses the libyaml bindings if available'''
+
+def parse_config(content: bytes) -> dict:
+    '''Parse the YAML of a config file or fragment, which must hold a mapping'''
+    config = yaml.load(content, YAML_LOADER)
+    if config is None:
+        config = {}
+    if not isinstance(config, dict):
+        raise ValueError('The DNS config file must contain a mapping at the top level')
+    for key in ('accounts', 'domains'):
+        if not isinstance(config.get(key) or [], list):
+            raise ValueError(f'The {key} of the DNS config must be a list')
+    return config
+
+def merge_fragments(fragments: dict[str, 'Fragment']) -> dict:
+    '''Merge the configs of fragments into one, concatenating their accounts and domains in order'''
+    config = {}
+    for fragment in fragments.values():
+        for key in ('accounts', 'domains'):
+            if key in fragment.config:
+                config.setdefault(key, []).extend(fragment.config[key] or [])
+    return config
+
+@dataclass(slots=True)
+class Fragment:
+    '''A config fragment, as of the last time it was read'''
+    file_stat: tuple[int, int]
+    '''Modification time and size of the fragment'''
+
+    file_hash: str
+    '''Content hash of the fragment'''
+
+    config: dict
+    '''The last valid configuration of the fragment'''
+
+@dataclass(slots=True)
+class Build:
+    '''The accounts and domains built from a configuration, see `ConfigManager.build`'''
+    config: dict
+    '''The configuration they were built from'''
+
+    machine_ips: tuple[str, str]
+    '''The machine IPv4 and IPv6 used for dynamic records'''
+
+    accounts: dict[str, tuple[dict, Account]] = field(default_factory=dict)
+    '''Configuration and marshalled account for all registered accounts, by name'''
+
+    domains: dict[str, tuple[dict, DomainConfig]] = field(default_factory=dict)
+    '''Configuration and marshalled domain for all registered domains, by name'''
+
+    rebuilt: set[str] = field(default_factory=set)
+    '''Names of the domains that were (re)built'''
+
+    rebuilt_dynamic: set[str] = field(default_factory=set)
+    '''Names of the domains that were rebuilt only because the machine IP changed'''
+
+    failed: list = field(default_factory=list)
+    '''The configuration entries that could not be built'''
+
+def build_account(account: dict) -> Optional[Account]:
+    '''
+    Marshal the configuration of an account into an `Account` and authenticate its provider.
+    Returns `None` if the account is misconfigured.
+    '''
+    # Check for account misconfiguration
+    if 'name' not in account:
+        LOG.warning(f'Misconfigured account detected. '
+                    'An account is missing a name and will not be created!')
+        return None
+    name = account['name']
+
+    if 'provider' not in account:
+        LOG.warning(f'Misconfigured account detected. '
+                    f'The account {name} has not set the provider and will not be created!')
+        return None
+    if account['provider'] not in ALL_PROVIDERS:
+        LOG.warning(f'Misconfigured account detected. '
+                    f'The account {name} uses the unknown provider {account["provider"]} and will not be created!')
+        return None
+
+    try:
+        transport_config = TransportConfig.from_config(account.get('http', {}))
+    except ValueError as E:
+        LOG.warning(f'Misconfigured account detected. '
+                    f'The account {name} has an invalid HTTP config and will not be created!\n{E}')
+        return None
+
+    try:
+        rate_limit_config = RateLimitConfig.from_config(account.get('rate_limit', {}))
+    except ValueError as E:
+        LOG.warning(f'Misconfigured account detected. '
+                    f'The account {name} has an invalid rate limit config and will not be created!\n{E}')
+        return None
+
+    try:
+        breaker_config = BreakerConfig.from_config(account.get('circuit_breaker', {}))
+    except ValueError as E:
+        LOG.warning(f'Misconfigured account detected. '
+                    f'The account {name} has an invalid circuit breaker config and will not be created!\n{E}')
+        return None
+
+    # Setup the account provider
+    transport = HTTPTransport(transport_config, RateLimiter(rate_limit_config))
+    account_provider = ALL_PROVIDERS[account['provider']](name, transport)
+    try:
+        account_provider.authenticate(account.get('credentials', {}))
+    except Exception as E:
+        LOG.warning(f'Failed to configure credentials for account {name}. '
+                    f'This account will not be created!\n{E}')
+        account_provider.close()
+        return None
+
+    concurrency = account.get('concurrency')
+    if concurrency is not None and (not isinstance(concurrency, int) or concurrency < 1):
+        LOG.warning(f'Misconfigured account detected. '
+                    f'The account {name} has an invalid concurrency "{concurrency}" which will be ignored.')
+        concurrency = None
+
+    interval = account.get('interval')
+    if interval is not None and not valid_interval(interval):
+        LOG.warning(f'Misconfigured account detected. '
+                    f'The account {name} has an invalid interval "{interval}" which will be ignored.')
+        interval = None
+
+    LOG.info(f'Registered account {name} with provider {account["provider"]}')
+    return Account(
+        name=name,
+        provider=account_provider,
+        concurrency=concurrency,
+        interval=interval,
+        breaker=CircuitBreaker(name, breaker_config),
+    )
+
+def as_int(value) -> Optional[int]:
+    '''Read an integer from the config, which may be quoted. Returns `None` if it isn't one'''
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    return None
+
+def valid_interval(interval) -> bool:
+    return not isinstance(interval, bool) and isinstance(interval, (int, float)) and interval > 0
+
+def build_domain(domain: dict, accounts: dict[str, Account], machine_ipv4: str, machine_ipv6: str) -> Optional[DomainConfig]:
+    '''
+    Marshal the configuration of a domain into a `DomainConfig`, filling in the machine IPs for
+    dynamic records. Returns `None` if the domain is misconfigured.
+    '''
+    # Check for misconfiguration of the domain
+    if 'name' not in domain:
+        LOG.warning(f'Misconfigured domain detected. '
+                    'A domain is missing a name and will not be reconciled!')
+        return None
+    name = domain['name']
+
+    if 'account' not in domain:
+        LOG.warning(f'Misconfigured domain detected. '
+                    f'The domain {name} has not set the account and will not be reconciled!')
+        return None
+    if domain['account'] not in accounts:
+        LOG.warning(f'Misconfigured domain detected. '
+                    f'The domain {name} is using the non-existent account {domain["account"]} '
+                    'and will not be reconciled!')
+        return None
+
+    if not isinstance(domain.get('records'), list):
+        LOG.warning(f'Misconfigured domain detected. '
+                    f'The domain {name} has no records and will not be reconciled!')
+        return None
+
+    # Now read the desired records for this domain
+    records = []
+    for record in domain['records']:
+        # Check for misconfiguration of the record
+        if not isinstance(record, dict):
+            LOG.warning(f'Misconfigured record detected. '
+                        f'A record for {name} is not a mapping ("{record}") and will not be reconciled!')
+            continue
+        if 'type' not in record:
+            LOG.warning(f'Misconfigured record detected. '
+                        f'A record for {name} has not set type and will not be reconciled!')
+            continue
+        if not isinstance(record['type'], str):
+            LOG.warning(f'Misconfigured record detected. '
+                        f'A record for {name} has an invalid type "{record["type"]}" and will not be reconciled!')
+            continue
+
+        # YAML reads hostnames like 2024 as numbers
+        hostname = record.get('hostname') or ''
+        if isinstance(hostname, (int, float)) and not isinstance(hostname, bool):
+            hostname = str(hostname)
+        if not isinstance(hostname, str):
+            LOG.warning(f'Misconfigured record detected. '
+                        f'A record for {name} has an invalid hostname "{hostname}" and will not be reconciled!')
+            continue
+
+        # If this is a dynamic record, use the machine's detected IP
+        dynamic_record = record.get('dynamic', False)
+        dynamic_answer = machine_ipv6 if record['type'] == 'AAAA' else machine_ipv4
+        if dynamic_record and dynamic_answer == '':
+            LOG.warning('Could not find machine IP for dynamic record. '
+                        f'{record["type"]} {hostname}.{name} will not be reconciled!')
+            continue
+
+        if not dynamic_record and 'answer' not in record:
+            LOG.warning(f'Misconfigured record detected. '
+                        f'A record for {name} has not set answer and will not be reconciled!')
+            continue
+
+        ttl = as_int(record.get('ttl', 600))
+        if ttl is None or ttl < 0:
+            LOG.warning(f'Misconfigured record detected. '
+                        f'A record for {name} has an invalid TTL "{record["ttl"]}" which will be ignored.')
+            ttl = 600
+        priority = record.get('priority')
+        if priority is not None:
+            priority = as_int(priority)
+            if priority is None:
+                LOG.warning(f'Misconfigured record detected. '
+                            f'A record for {name} has an invalid priority "{record["priority"]}" which will be ignored.')
+
+        # Marshal the record configuration
+        records.append(DNSRecord(
+            hostname=hostname,
+            type=record['type'],
+            answer=(dynamic_answer if dynamic_record else record.get('answer', '')),
+            ttl=ttl,
+            priority=priority,
+            dynamic=dynamic_record,
+        ))
+
+    # Then compile the rules for *ignored* records
+    ignored_records = []
+    for record in domain.get('ignored_records', []):
+        try:
+            ignored_records.append(IgnoreRule.from_config(record))
+        except ValueError as E:
+            LOG.warning(f'Misconfigured ignore record detected. '
+                        f'An ignore record for {name} is invalid ({E}) and will not be ignored!')
+
+    interval = domain.get('interval')
+    if interval is not None and not valid_interval(interval):
+        LOG.warning(f'Misconfigured domain detected. '
+                    f'The domain {name} has an invalid interval "{interval}" which will be ignored.')
+        interval = None
+
+    ignore_info = f' and {len(ignored_records)} ignored record(s)' if len(ignored_records) else ''
+    LOG.info(f'Registered domain {name} with {len(records)} record(s){ignore_info} using account {domain["account"]}')
+    return DomainConfig(
+        name=name,
+        records=records,
+        ignored_records=ignored_records,
+        ignore=IgnoreMatcher(ignored_records),
+        account=accounts[domain['account']],
+        interval=interval,
+    )
+
+def dynamic_families(domain: dict) -> set[str]:
+    '''
+    Get the address record types (A for the machine IPv4, AAAA for the IPv6) that the dynamic
+    records in the configuration of a domain depend on
+    '''
+    return {
+        'AAAA' if record.get('type') == 'AAAA' else 'A'
+        for record in domain.get('records', None) or []
+        if isinstance(record, dict) and record.get('dynamic', False)
+    }
+
+class ConfigManager:
+    '''
+    Loads the DNS configuration file and keeps the marshalled accounts and domains around between
+    reconciliation cycles.
+
+    The file is fingerprinted by its modification time, size and content hash. While it's unchanged,
+    the previously loaded domains are reused as they are. When it does change, only the accounts and
+    domains whose configuration actually changed are rebuilt, so providers (and their pooled
+    connections) of unchanged accounts survive and aren't re-authenticated.
+
+    The config may also be a directory of YAML fragments, each holding `accounts` and/or `domains`
+    like a config file, which are merged in file name order. Every fragment is fingerprinted on its
+    own, so only the fragments that changed are parsed again. A fragment that can't be parsed, or
+    whose accounts or domains can't be built, is reported and its last valid version is used
+    instead, so it doesn't hold up the other fragments.
+    '''
+    def __init__(self, config_path: str) -> None:
+        self.config_path = config_path
+
+        self.file_stat: Optional[tuple[int, int]] = None
+        '''Modification time and size of the config file as of the last load'''
+
+        self.file_hash: Optional[str] = None
+        '''Content hash of the config file as of the last load'''
+
+        self.config: dict = {}
+        '''The last successfully parsed configuration'''
+
+        self.fragments: dict[str, Fragment] = {}
+        '''The fragments of the config as of the last load, by path, if the config is a directory'''
+
+        self.machine_ips: tuple[str, str] = ('', '')
+        '''The machine IPv4 and IPv6 used for dynamic records as of the last load'''
+
+        self.accounts: dict[str, tuple[dict, Account]] = {}
+        '''Configuration and marshalled account for all registered accounts, by name'''
+
+        self.domains: dict[str, tuple[dict, DomainConfig]] = {}
+        '''Configuration and marshalled domain for all registered domains, by name'''
+
+        self.domain_configs: list[DomainConfig] = []
+        '''All registered domains, in configuration order'''
+
+        self.rebuilt: set[str] = set()
+        '''Names of the domains that were (re)built by the last load'''
+
+        self.rebuilt_dynamic: set[str] = set()
+        '''
+        Names of the domains that were rebuilt by the last load only because the machine IP changed,
+        i.e. only their dynamic records differ from the previous load
+        '''
+
+    def read(self) -> Optional[tuple[dict, tuple[tuple[int, int], str]]]:
+        '''
+        Read and parse the config file if it changed since the last load. Returns the config along
+        with the fingerprint of the file, which is only remembered once the config has been loaded,
+        or `None` if the file is unchanged.
+        '''
+        stat = os.stat(self.config_path)
+        file_stat = (stat.st_mtime_ns, stat.st_size)
+        if file_stat == self.file_stat:
+            return None
+
+        with open(self.config_path, 'rb') as cfg_file:
+            content = cfg_file.read()
+        file_hash = hashlib.sha256(content).hexdigest()
+        if file_hash == self.file_hash:
+            # Touched, but not actually changed
+            self.file_stat = file_stat
+            return None
+
+        LOG.info(f'Reading DNS configuration from {self.config_path}')
+        return parse_config(content), (file_stat, file_hash)
+
+    def read_directory(self) -> Optional[dict[str, Fragment]]:
+        '''
+        Read and parse the fragments of the config directory that changed since the last load.
+        Returns the fragments to load by path, or `None` if no fragment changed. A fragment that
+        can't be parsed is replaced by its last valid version, or left out if it has none.
+        '''
+        paths = sorted(
+            os.path.join(self.config_path, name) for name in os.listdir(self.config_path)
+            if is_fragment(name)
+        )
+
+        fragments: dict[str, Fragment] = {}
+        changed: dict[str, tuple[tuple[int, int], str, bytes]] = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                file_stat = (stat.st_mtime_ns, stat.st_size)
+                cached = self.fragments.get(path)
+                if cached is not None and cached.file_stat == file_stat:
+                    fragments[path] = cached
+                    continue
+
+                with open(path, 'rb') as fragment_file:
+                    content = fragment_file.read()
+            except OSError:
+                # Removed since it was listed
+                continue
+
+            file_hash = hashlib.sha256(content).hexdigest()
+            if cached is not None and cached.file_hash == file_hash:
+                # Touched, but not actually changed
+                cached.file_stat = file_stat
+                fragments[path] = cached
+                continue
+            changed[path] = (file_stat, file_hash, content)
+
+        if not changed and fragments.keys() == self.fragments.keys():
+            return None
+
+        if changed:
+            LOG.info(f'Reading DNS configuration from {len(changed)} changed fragment(s) in {self.config_path}')
+        for path, (file_stat, file_hash, content) in changed.items():
+            try:
+                fragments[path] = Fragment(file_stat, file_hash, parse_config(content))
+                continue
+            except Exception as E:
+                error = E
+
+            # The broken version isn't remembered, so it is read again until it is fixed
+            cached = self.fragments.get(path)
+            fallback = 'its last valid version will be used' if cached else 'it will be ignored'
+            LOG.warning(f'Misconfigured config fragment detected. '
+                        f'The fragment {path} could not be parsed and {fallback}!\n{error}')
+            if cached is not None:
+                fragments[path] = cached
+
+        # Keep the fragments in file name order
+        return {path: fragments[path] for path in paths if path in fragments}
+
+    def load_directory(self, machine_ipv4: str, machine_ipv6: str) -> list[DomainConfig]:
+        '''
+        Load the config directory, see `load`. Fragments whose accounts or domains fail to build are
+        replaced by their last valid version, just like fragments that fail to parse.
+        '''
+        fragments = self.read_directory()
+        if fragments is None:
+            if (machine_ipv4, machine_ipv6) != self.machine_ips:
+                self.update(self.config, machine_ipv4, machine_ipv6)
+            else:
+                self.rebuilt = set()
+                self.rebuilt_dynamic = set()
+            return self.domain_configs
+
+        build = self.build(merge_fragments(fragments), machine_ipv4, machine_ipv6)
+        failed = {id(entry) for entry in build.failed}
+        broken = [
+            path for path, fragment in fragments.items()
+            if fragment is not self.fragments.get(path) and any(
+                id(entry) in failed
+                for key in ('accounts', 'domains') for entry in fragment.config.get(key) or []
+            )
+        ]
+        if broken:
+            for path in broken:
+                cached = self.fragments.get(path)
+                fallback = 'its last valid version will be used' if cached else 'it will be ignored'
+                LOG.warning(f'Misconfigured config fragment detected. '
+                            f'The fragment {path} could not be loaded and {fallback}!')
+                if cached is not None:
+                    fragments[path] = cached
+                else:
+                    del fragments[path]
+            build = self.build(merge_fragments(fragments), machine_ipv4, machine_ipv6, build)
+
+        self.commit(build)
+        self.fragments = fragments
+        return self.domain_configs
+
+    def load(self, machine_ipv4: str, machine_ipv6: str) -> list[DomainConfig]:
+        '''
+        Get the desired state as a list of DomainConfigs, reloading only what changed in the
+        configuration (or through changes of the machine IPs) since the last load
+        '''
+        if not os.path.exists(self.config_path):
+            LOG.warning(f'The configuration file {self.config_path} does not exist!')
+            self.file_stat = self.file_hash = None
+            self.fragments = {}
+            self.close()
+            return []
+
+        if os.path.isdir(self.config_path):
+            return self.load_directory(machine_ipv4, machine_ipv6)
+
+        read = self.read()
+        machine_ips = (machine_ipv4, machine_ipv6)
+        if read is None and machine_ips == self.machine_ips:
+            self.rebuilt = set()
+            self.rebuilt_dynamic = set()
+            return self.domain_configs
+
+        config, fingerprint = read if read is not None else (self.config, None)
+        self.update(config, machine_ipv4, machine_ipv6)
+        # Only remembered now, so that a config that failed to load is loaded again next time
+        if fingerprint is not None:
+            self.file_stat, self.file_hash = fingerprint
+        return self.domain_configs
+
+    def update(self, config: dict, machine_ipv4: str, machine_ipv6: str) -> list:
+        '''
+        Rebuild the accounts and domains that differ from the given configuration. An account or
+        domain that can't be built is reported and left out, without affecting the others.
+        Returns the configuration entries that could not be built.
+        '''
+        build = self.build(config, machine_ipv4, machine_ipv6)
+        self.commit(build)
+        return build.failed
+
+    def build(self, config: dict, machine_ipv4: str, machine_ipv6: str, previous: 'Build' = None) -> 'Build':
+        '''
+        Build the accounts and domains of the given configuration, reusing the loaded ones (or those
+        of a `previous` build that was not committed) that are unchanged. Nothing is kept until the
+        build is committed, see `commit`.
+        '''
+        changed_ips = set()
+        if machine_ipv4 != self.machine_ips[0]:
+            changed_ips.add('A')
+        if machine_ipv6 != self.machine_ips[1]:
+            changed_ips.add('AAAA')
+        caches = [self] if previous is None else [self, previous]
+
+        if 'accounts' not in config:
+            LOG.warning('The DNS config file is missing account configuration!')
+        if 'domains' not in config:
+            LOG.warning('The DNS config file is missing domain configuration!')
+
+        # Deal with reading account config and setting those up first
+        build = Build(config, (machine_ipv4, machine_ipv6))
+        accounts = build.accounts
+        for account_cfg in config.get('accounts', None) or []:
+            if not isinstance(account_cfg, dict):
+                LOG.warning(f'Misconfigured account detected. '
+                            f'An account is not a mapping ("{account_cfg}") and will not be created!')
+                build.failed.append(account_cfg)
+                continue
+            name = account_cfg.get('name')
+            cached = next((cache.accounts[name] for cache in caches
+                           if name in cache.accounts and cache.accounts[name][0] == account_cfg), None)
+            if cached is not None:
+                accounts[name] = cached
+                continue
+
+            try:
+                account = build_account(account_cfg)
+            except Exception as E:
+                LOG.warning(f'Misconfigured account detected. '
+                            f'The account {name} could not be created!\n{E}')
+                build.failed.append(account_cfg)
+                continue
+            if account is not None:
+                if name in accounts:
+                    accounts[name][1].provider.close()
+                accounts[name] = (account_cfg, account)
+
+        all_accounts = {name: account for name, (_, account) in accounts.items()}
+
+        domains = build.domains
+        for domain_cfg in (config.get('domains', None) or []) if 'accounts' in config else []:
+            if not isinstance(domain_cfg, dict):
+                LOG.warning(f'Misconfigured domain detected. '
+                            f'A domain is not a mapping ("{domain_cfg}") and will not be reconciled!')
+                build.failed.append(domain_cfg)
+                continue
+            name = domain_cfg.get('name')
+            if name in domains:
+                LOG.warning(f'Misconfigured domain detected. '
+                            f'The domain {name} is configured more than once, only the first will be reconciled!')
+                continue
+
+            # Reuse the domain unless its config, its account or its dynamic IPs have changed
+            cached = self.domains.get(name)
+            unchanged = cached is not None and cached[0] == domain_cfg and \
+                        cached[1].account is all_accounts.get(domain_cfg.get('account'))
+            if unchanged and not (changed_ips & dynamic_families(domain_cfg)):
+                domains[name] = cached
+                continue
+
+            # Or reuse what the previous build made of it
+            if previous is not None and name in previous.rebuilt:
+                built = previous.domains[name]
+                if built[0] == domain_cfg and built[1].account is all_accounts.get(domain_cfg.get('account')):
+                    domains[name] = built
+                    build.rebuilt.add(name)
+                    if name in previous.rebuilt_dynamic:
+                        build.rebuilt_dynamic.add(name)
+                    continue
+
+            try:
+                domain = build_domain(domain_cfg, all_accounts, machine_ipv4, machine_ipv6)
+            except Exception as E:
+                LOG.warning(f'Misconfigured domain detected. '
+                            f'The domain {name} could not be read and will not be reconciled!\n{E}')
+                build.failed.append(domain_cfg)
+                continue
+            if domain is not None:
+                domains[name] = (domain_cfg, domain)
+                build.rebuilt.add(name)
+                if unchanged:
+                    build.rebuilt_dynamic.add(name)
+
+        if previous is not None:
+            # Release the providers the previous build created but that this one doesn't use
+            for name, (_, account) in previous.accounts.items():
+                if all_accounts.get(name) is not account and self.accounts.get(name, (None, None))[1] is not account:
+                    account.provider.close()
+        return build
+
+    def commit(self, build: 'Build') -> None:
+        '''Keep the accounts and domains of a build, releasing the providers of the replaced accounts'''
+        for name, (_, account) in self.accounts.items():
+            if build.accounts.get(name, (None, None))[1] is not account:
+                account.provider.close()
+
+        self.config = build.config
+        self.machine_ips = build.machine_ips
+        self.accounts = build.accounts
+        self.domains = build.domains
+        self.domain_configs = [domain for _, domain in build.domains.values()]
+        self.rebuilt = build.rebuilt
+        self.rebuilt_dynamic = build.rebuilt_dynamic
+
+    def close(self) -> None:
+        '''Release the providers of all registered accounts and forget the loaded configuration'''
+        for _, account in self.accounts.values():
+            account.provider.close()
+        self.config = {}
+        self.machine_ips = ('', '')
+        self.accounts = {}
+        self.domains = {}
+        self.domain_configs = []
+        self.rebuilt = set()
+        self.rebuilt_dynamic = set()
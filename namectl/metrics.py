@@ -0,0 +1,186 @@
+import time
+import logging
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from typing import Callable, Iterable, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from http.server import ThreadingHTTPServer
+
+LOG = logging.getLogger('namectl')
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+METRICS: dict[str, tuple[str, str]] = {
+    'namectl_cycle_duration_seconds': (HISTOGRAM, 'Duration of reconciliation cycles'),
+    'namectl_config_load_seconds': (HISTOGRAM, 'Time spent loading the DNS configuration'),
+    'namectl_ip_discovery_seconds': (HISTOGRAM, 'Time spent discovering the machine IPs'),
+    'namectl_api_call_seconds': (HISTOGRAM, 'Latency of calls to the registrar'),
+    'namectl_api_calls_total': (COUNTER, 'Calls made to the registrar, by outcome'),
+    'namectl_record_changes_total': (COUNTER, 'Records created, updated or deleted'),
+    'namectl_record_update_reasons_total': (COUNTER, 'Records updated, by what differed from the desired record'),
+    'namectl_record_change_errors_total': (COUNTER, 'Record creates, updates or deletes that failed'),
+    'namectl_reconcile_errors_total': (COUNTER, 'Domain reconciliations that failed'),
+    'namectl_last_success_timestamp_seconds': (GAUGE, 'Unix time of the last successful reconciliation of a domain'),
+    'namectl_deadline_exceeded_total': (COUNTER, 'Domain reconciliations that ran out of time'),
+    'namectl_domains_skipped_total': (COUNTER, 'Domains skipped because of an open circuit breaker or the cycle running out of time'),
+    'namectl_circuit_breaker_state': (GAUGE, 'State of the circuit breaker of an account, 0 closed, 1 half-open, 2 open'),
+    'namectl_circuit_breaker_skipped_total': (COUNTER, 'Domains of an account skipped by its circuit breaker'),
+    'namectl_rate_limit_rate': (GAUGE, 'Current call rate allowed by the rate limiter of an account'),
+    'namectl_rate_limit_tokens': (GAUGE, 'Calls that may currently be made at once by an account'),
+    'namectl_rate_limit_throttled_total': (COUNTER, 'Calls throttled by the registrar, per account'),
+    'namectl_rate_limit_wait_seconds_total': (COUNTER, 'Time calls have spent waiting for the rate limiter of an account'),
+}
+'''Type and description of every metric namectl exposes, by name'''
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+'''Upper bounds of the histogram buckets, in seconds'''
+
+Labels = tuple[tuple[str, str], ...]
+
+class Registry:
+    '''Thread safe store of metric samples, which can be rendered in the Prometheus text format'''
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.values: dict[str, dict[Labels, float]] = {}
+        self.histograms: dict[str, dict[Labels, list]] = {}
+        self.collectors: list[Callable[[], Iterable[tuple[str, dict, float]]]] = []
+
+    def inc(self, name: str, amount: float, labels: Labels) -> None:
+        with self.lock:
+            series = self.values.setdefault(name, {})
+            series[labels] = series.get(labels, 0.0) + amount
+
+    def set(self, name: str, value: float, labels: Labels) -> None:
+        with self.lock:
+            self.values.setdefault(name, {})[labels] = value
+
+    def observe(self, name: str, value: float, labels: Labels) -> None:
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            # Bucket counts (the last one being +Inf), sum and count
+            histogram = series.get(labels)
+            if histogram is None:
+                histogram = series[labels] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+            histogram[0][bisect_left(BUCKETS, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def render(self) -> str:
+        '''Render all metrics in the Prometheus text exposition format'''
+        collected: dict[str, dict[Labels, float]] = {}
+        for collector in self.collectors:
+            try:
+                for name, labels, value in collector():
+                    collected.setdefault(name, {})[freeze(labels)] = value
+            except Exception as E:
+                LOG.warning(f'Failed to collect metrics\n{E}')
+
+        lines = []
+        with self.lock:
+            for name, (metric_type, description) in METRICS.items():
+                values = {**self.values.get(name, {}), **collected.get(name, {})}
+                histograms = self.histograms.get(name, {})
+                if not values and not histograms:
+                    continue
+
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} {metric_type}')
+                for labels, value in values.items():
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                for labels, (buckets, total, count) in histograms.items():
+                    cumulative = 0
+                    for bound, bucket in zip(BUCKETS + ('+Inf',), buckets):
+                        cumulative += bucket
+                        lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                    lines.append(f'{name}_sum{format_labels(labels)} {total}')
+                    lines.append(f'{name}_count{format_labels(labels)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+def freeze(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+def escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+REGISTRY: Optional[Registry] = None
+'''The active registry. Metrics are only recorded while the metrics endpoint is enabled'''
+
+def enabled() -> bool:
+    return REGISTRY is not None
+
+def inc(name: str, amount: float = 1, **labels) -> None:
+    '''Increment a counter'''
+    if REGISTRY is not None:
+        REGISTRY.inc(name, amount, freeze(labels))
+
+def set_gauge(name: str, value: float, **labels) -> None:
+    '''Set a gauge'''
+    if REGISTRY is not None:
+        REGISTRY.set(name, value, freeze(labels))
+
+def observe(name: str, value: float, **labels) -> None:
+    '''Record an observation in a histogram'''
+    if REGISTRY is not None:
+        REGISTRY.observe(name, value, freeze(labels))
+
+@contextmanager
+def _timed(name: str, labels: dict):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        REGISTRY.observe(name, time.perf_counter() - started, freeze(labels))
+
+def timer(name: str, **labels):
+    '''Context manager recording how long its body took in a histogram'''
+    if REGISTRY is None:
+        return nullcontext()
+    return _timed(name, labels)
+
+def register_collector(collector: Callable[[], Iterable[tuple[str, dict, float]]]) -> None:
+    '''
+    Register a function that is called on every scrape and returns (name, labels, value) samples,
+    for metrics that are cheaper to read on demand than to keep up to date
+    '''
+    if REGISTRY is not None:
+        REGISTRY.collectors.append(collector)
+
+def start_server(port: int, address: str = '') -> 'ThreadingHTTPServer':
+    '''Enable metrics and serve them on `/metrics` at the given address and port'''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    global REGISTRY
+    if REGISTRY is None:
+        REGISTRY = Registry()
+    registry = REGISTRY
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *_) -> None:
+            pass
+
+        def do_GET(self) -> None:
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+
+            body = registry.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer((address, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='namectl-metrics', daemon=True).start()
+    LOG.info(f'Serving metrics on http://{address or "0.0.0.0"}:{server.server_address[1]}/metrics')
+    return server
@@ -1,15 +1,218 @@
-import requests
+import os
+import time
+import socket
+import logging
+import ipaddress
+import threading
+from abc import abstractmethod, ABC
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Optional
+from namectl import metrics
+
+LOG = logging.getLogger('namectl')
+
+class IPSource(ABC):
+    '''A way of finding out the public IPv4 or IPv6 of the machine'''
+    name: str = ''
+
+    @abstractmethod
+    def fetch(self, version: int, timeout: float) -> str:
+        '''
+        Get the IP of the given version (4 or 6) within `timeout` seconds.
+        Raises an exception if the IP could not be found.
+        '''
+        raise NotImplementedError(f'IP source "{self.name}" must implement method fetch')
+
+def validate_ip(address: str, version: int, require_global: bool = False) -> str:
+    '''Check that the address is an IP of the given version, returning it in canonical form'''
+    ip = ipaddress.ip_address(address.strip())
+    if ip.version != version:
+        raise ValueError(f'Expected an IPv{version}, got {address}')
+    if require_global and not ip.is_global:
+        raise ValueError(f'{address} is not a globally routable address')
+    return str(ip)
+
+class HTTPEchoSource(IPSource):
+    '''
+    Asks a HTTP echo service for the address the request came from.
+    The service either responds with the bare address, or with JSON containing it under `json_key`.
+    '''
+    def __init__(self, name: str, url4: Optional[str], url6: Optional[str], json_key: Optional[str] = None) -> None:
+        self.name = name
+        self.urls = {4: url4, 6: url6}
+        self.json_key = json_key
+
+    def fetch(self, version: int, timeout: float) -> str:
+        url = self.urls[version]
+        if url is None:
+            raise RuntimeError(f'{self.name} does not support IPv{version}')
+
+        # Imported here, as discovering the IPs from the interfaces doesn't need it
+        import requests
+        resp = requests.get(url, timeout=timeout)
+        if resp.status_code != 200:
+            raise RuntimeError(f'Failed to ping against {self.name}')
+        address = resp.json()[self.json_key] if self.json_key else resp.text
+        return validate_ip(address, version)
+
+class InterfaceSource(IPSource):
+    '''
+    Reads the global address straight from the local network interfaces, without any network round
+    trip. This only finds the public IP if the machine is directly reachable, i.e. not behind NAT,
+    which is usually the case for IPv6.
+    '''
+    name = 'interface'
+
+    # Address flags from linux/if_addr.h
+    IFA_F_TEMPORARY = 0x01
+    IFA_F_DEPRECATED = 0x20
+    IFA_F_TENTATIVE = 0x40
+
+    # Well known public resolvers, only used to pick the outgoing interface. No packets are sent.
+    PROBE_ADDRESSES = {4: '8.8.8.8', 6: '2001:4860:4860::8888'}
+
+    def fetch(self, version: int, timeout: float) -> str:
+        if version == 6 and os.path.exists('/proc/net/if_inet6'):
+            return self.read_if_inet6()
+        return self.outgoing_address(version)
+
+    def read_if_inet6(self) -> str:
+        '''Find a stable, global IPv6 among the addresses of all interfaces'''
+        unusable = self.IFA_F_TEMPORARY | self.IFA_F_DEPRECATED | self.IFA_F_TENTATIVE
+        with open('/proc/net/if_inet6') as if_inet6:
+            for line in if_inet6:
+                fields = line.split()
+                if len(fields) < 6 or int(fields[4], 16) & unusable:
+                    continue
+                address = ':'.join(fields[0][i:i + 4] for i in range(0, 32, 4))
+                try:
+                    return validate_ip(address, 6, require_global=True)
+                except ValueError:
+                    continue
+        raise RuntimeError('No interface has a global IPv6')
+
+    def outgoing_address(self, version: int) -> str:
+        '''Find the local address the machine would use to reach the internet'''
+        family = socket.AF_INET6 if version == 6 else socket.AF_INET
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            # Connecting a UDP socket only selects a route, it doesn't send anything
+            sock.connect((self.PROBE_ADDRESSES[version], 53))
+            return validate_ip(sock.getsockname()[0], version, require_global=True)
+
+IP_SOURCES: dict[str, Callable[[], IPSource]] = {
+    'ipify': lambda: HTTPEchoSource('ipify', 'https://api.ipify.org?format=json',
+                                    'https://api6.ipify.org?format=json', json_key='ip'),
+    'icanhazip': lambda: HTTPEchoSource('icanhazip', 'https://ipv4.icanhazip.com', 'https://ipv6.icanhazip.com'),
+    'identme': lambda: HTTPEchoSource('identme', 'https://v4.ident.me', 'https://v6.ident.me'),
+    'interface': InterfaceSource,
+}
+'''All known IP sources, by name'''
+
+def make_source(name: str) -> IPSource:
+    '''
+    Create an IP source from its name. Any HTTP(S) URL is used as an echo service responding with
+    the bare address, for both IPv4 and IPv6.
+    '''
+    if name.startswith('http://') or name.startswith('https://'):
+        return HTTPEchoSource(name, name, name)
+    if name not in IP_SOURCES:
+        raise ValueError(f'Unknown IP source "{name}". Choose from {", ".join(IP_SOURCES)} or a URL')
+    return IP_SOURCES[name]()
+
+class IPDiscovery:
+    '''
+    Discovers the public IPv4 and IPv6 of the machine.
+
+    Both IP versions are looked up concurrently, trying each source in order until one of them
+    succeeds, and the whole lookup has to finish within `timeout` seconds. Results are cached for
+    `cache_ttl` seconds. Whenever a discovery finds different IPs than the previous one, `on_change`
+    is called with the new IPs. If an IP can't be looked up, its last known value is kept, as the
+    failure says nothing about whether it changed.
+    '''
+    def __init__(
+        self,
+        sources: list[IPSource],
+        timeout: float = 3.0,
+        cache_ttl: float = 30.0,
+        on_change: Callable[[tuple[str, str]], None] = None,
+    ) -> None:
+        self.sources = sources
+        self.timeout = timeout
+        self.cache_ttl = cache_ttl
+        self.on_change = on_change
+
+        self.ips: Optional[tuple[str, str]] = None
+        '''The last discovered IPv4 and IPv6. An IP is empty if it has never been found'''
+
+        self.discovered_at = 0.0
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix='namectl-ip')
+
+    def lookup(self, version: int, deadline: float) -> str:
+        '''Get the IP of the given version from the first source that knows it'''
+        errors = []
+        for source in self.sources:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                errors.append('ran out of time')
+                break
+            try:
+                return source.fetch(version, remaining)
+            except Exception as E:
+                errors.append(f'{source.name}: {E}')
+
+        raise RuntimeError('; '.join(errors))
+
+    def discover(self, force: bool = False) -> tuple[str, str]:
+        '''Get the IPv4 and IPv6 of the machine, using the cached IPs if they're fresh enough'''
+        with self.lock:
+            if not force and self.ips is not None and time.monotonic() - self.discovered_at < self.cache_ttl:
+                return self.ips
+
+            started = time.monotonic()
+            deadline = started + self.timeout
+            futures = {version: self.pool.submit(self.lookup, version, deadline) for version in (4, 6)}
+            wait(futures.values(), timeout=self.timeout)
+            metrics.observe('namectl_ip_discovery_seconds', time.monotonic() - started)
+
+            found = {}
+            for version, future in futures.items():
+                if not future.done():
+                    error = f'no source responded within {self.timeout}s'
+                elif future.exception() is not None:
+                    error = future.exception()
+                else:
+                    found[version] = future.result()
+                    continue
+
+                # A failed lookup doesn't mean the IP changed, so the last known IP is kept. Dropping
+                # it would rebuild the dynamic records without it, and have them deleted as orphans
+                known = self.ips[version == 6] if self.ips is not None else ''
+                found[version] = known
+                record_type = 'AAAA' if version == 6 else 'A'
+                if known:
+                    LOG.warning(f'Failed to get IPv{version}, keeping the last known IPv{version} {known}\n{error}')
+                elif self.ips is None:
+                    # Only complain about a missing IP once, not on every discovery
+                    LOG.warning(f'Failed to get IPv{version}, dynamic {record_type} records will not be reconciled\n{error}')
+
+            ips = (found[4], found[6])
+            previous, self.ips = self.ips, ips
+            self.discovered_at = time.monotonic()
+
+        if ips != previous:
+            for version, ip in zip((4, 6), ips):
+                if ip and (previous is None or previous[version == 6] != ip):
+                    LOG.info(f'Current IPv{version} is: {ip}')
+            if previous is not None and self.on_change:
+                self.on_change(ips)
+
+        return ips
 
 def ping4() -> str:
     '''Get the IPv4 of the machine performing this ping'''
-    resp = requests.get('https://api.ipify.org?format=json')
-    if resp.status_code != 200:
-        raise RuntimeError('Failed to ping against ipify.org')
-    return resp.json()['ip']
+    return make_source('ipify').fetch(4, 10)
 
 def ping6() -> str:
     '''Get the IPv6 of the machine performing this ping'''
-    resp = requests.get('https://api6.ipify.org?format=json')
-    if resp.status_code != 200:
-        raise RuntimeError('Failed to ping against ipify.org')
-    return resp.json()['ip']
+    return make_source('ipify').fetch(6, 10)
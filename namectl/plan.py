@@ -0,0 +1,332 @@
+from collections import Counter, deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Iterable, Optional, TYPE_CHECKING
+from namectl import metrics
+from namectl.config import DNSRecord
+
+if TYPE_CHECKING:
+    from namectl.ignore import IgnoreMatcher
+    from namectl.providers import DNSProvider
+
+@dataclass
+class RecordUpdate:
+    existing: DNSRecord
+    '''The existing record that should be corrected'''
+
+    desired: DNSRecord
+    '''The desired record the existing record should be corrected to'''
+
+    reasons: tuple[str, ...] = ()
+    '''What differs between the existing and desired record, out of `answer`, `ttl` and `priority`'''
+
+def record_to_json(record: DNSRecord) -> dict:
+    return {
+        'hostname': record.hostname,
+        'type': record.type,
+        'answer': record.answer,
+        'ttl': record.ttl,
+        'priority': record.priority,
+        'id': record.id,
+    }
+
+def record_from_json(data: dict) -> DNSRecord:
+    return DNSRecord(
+        hostname=data['hostname'],
+        type=data['type'],
+        answer=data['answer'],
+        ttl=data['ttl'],
+        priority=data.get('priority'),
+        id=data.get('id'),
+    )
+
+def differences(existing: DNSRecord, desired: DNSRecord) -> tuple[str, ...]:
+    '''Get what differs between an existing record and the desired record it should match'''
+    reasons = []
+    if existing.answer != desired.answer:
+        reasons.append('answer')
+    if existing.ttl != desired.ttl:
+        reasons.append('ttl')
+    if desired.priority is not None and existing.priority != desired.priority:
+        reasons.append('priority')
+    return tuple(reasons)
+
+@dataclass
+class DomainPlan:
+    '''
+    The set of changes needed to bring the records of a domain in line with its desired state.
+    Changes are applied in the order updates, deletes, creates.
+    '''
+    domain: str
+    '''The name of the domain this plan is for'''
+
+    creates: list[DNSRecord] = field(default_factory=list)
+    '''Desired records that have no existing counterpart and must be created'''
+
+    updates: list[RecordUpdate] = field(default_factory=list)
+    '''Existing records whose content, TTL or priority must be corrected'''
+
+    deletes: list[DNSRecord] = field(default_factory=list)
+    '''Existing records that are not desired (orphaned) and must be deleted'''
+
+    ignores: list[DNSRecord] = field(default_factory=list)
+    '''Existing records that matched an ignore rule and are left alone'''
+
+    unchanged: list[DNSRecord] = field(default_factory=list)
+    '''Existing records that already match a desired record'''
+
+    counts: Optional[tuple[int, int]] = None
+    '''
+    How many records were unchanged and ignored, for plans read with `from_json`, which only keep
+    the records that change
+    '''
+
+    def unchanged_ignored(self) -> tuple[int, int]:
+        '''How many records are unchanged and how many are ignored'''
+        return self.counts if self.counts is not None else (len(self.unchanged), len(self.ignores))
+
+    @property
+    def empty(self) -> bool:
+        '''Whether or not the plan has no changes to apply'''
+        return not (self.creates or self.updates or self.deletes)
+
+    def churn(self) -> str:
+        '''Summarize the changes of the plan, with the reasons records are updated'''
+        reasons = Counter(reason for update in self.updates for reason in update.reasons)
+        update_info = ''
+        if reasons:
+            update_info = ' (' + ', '.join(f'{reason}: {count}' for reason, count in reasons.most_common()) + ')'
+        return (f'{len(self.creates)} create(s), {len(self.updates)} update(s){update_info}, '
+                f'{len(self.deletes)} delete(s), {self.unchanged_ignored()[0]} unchanged')
+
+    def touched_keys(self) -> set[tuple[str, str]]:
+        '''The (type, hostname) of every record the plan changes'''
+        keys = {(record.type, record.hostname) for record in self.creates + self.deletes}
+        keys.update((update.existing.type, update.existing.hostname) for update in self.updates)
+        return keys
+
+    def to_json(self) -> dict:
+        '''Serialize the changes of the plan, including the IDs of the existing records they act on'''
+        unchanged, ignored = self.unchanged_ignored()
+        return {
+            'domain': self.domain,
+            'creates': [record_to_json(record) for record in self.creates],
+            'updates': [{
+                'existing': record_to_json(update.existing),
+                'desired': record_to_json(update.desired),
+                'reasons': list(update.reasons),
+            } for update in self.updates],
+            'deletes': [record_to_json(record) for record in self.deletes],
+            'unchanged': unchanged,
+            'ignored': ignored,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'DomainPlan':
+        '''Read the changes of a plan serialized with `to_json`'''
+        return cls(
+            domain=data['domain'],
+            creates=[record_from_json(record) for record in data['creates']],
+            updates=[RecordUpdate(
+                existing=record_from_json(update['existing']),
+                desired=record_from_json(update['desired']),
+                reasons=tuple(update.get('reasons', ())),
+            ) for update in data['updates']],
+            deletes=[record_from_json(record) for record in data['deletes']],
+            counts=(data.get('unchanged', 0), data.get('ignored', 0)),
+        )
+
+CREATE = 'create'
+UPDATE = 'update'
+DELETE = 'delete'
+
+@dataclass
+class ChangeResult:
+    '''The outcome of a single operation performed while applying a plan'''
+    action: str
+    '''The kind of operation, one of `create`, `update` or `delete`'''
+
+    record: DNSRecord
+    '''The record that was created or deleted, or the desired record for updates'''
+
+    existing: Optional[DNSRecord] = None
+    '''For updates, the existing record that was corrected'''
+
+    value: Any = None
+    '''Whatever the provider returned for the operation, e.g. the ID of a created record'''
+
+    error: Optional[Exception] = None
+    '''The error that made the operation fail, if it failed'''
+
+    @property
+    def ok(self) -> bool:
+        '''Whether or not the operation succeeded'''
+        return self.error is None
+
+    def run(self, operation: Callable[[], Any]) -> 'ChangeResult':
+        '''Perform the operation, recording its return value or error in this result'''
+        try:
+            self.value = operation()
+        except Exception as E:
+            self.error = E
+        return self
+
+    def describe(self, domain: str) -> str:
+        '''Get a human readable description of the operation'''
+        record = self.record
+        if self.action == DELETE:
+            return f'{record.type} {record.hostname}.{domain} -> {record.answer}'
+        description = f'{record.type} {record.hostname}.{domain} -> {record.answer} (TTL={record.ttl})'
+        if self.existing is not None and self.existing.hostname != record.hostname:
+            description = f'{self.existing.type} {self.existing.hostname}.{domain} => {description}'
+        return description
+
+class _Candidates:
+    '''
+    The existing records sharing a single (type, hostname) key, in listing order.
+
+    Records are indexed by content so that finding the first exact match for a desired record does
+    not require scanning every candidate. Consumed records are removed from `pending` and lazily
+    skipped in the content indexes.
+    '''
+    __slots__ = ('pending', 'by_content', 'by_content_priority')
+
+    def __init__(self) -> None:
+        self.pending: dict[int, DNSRecord] = {}
+        self.by_content: dict[tuple, deque[int]] = {}
+        self.by_content_priority: dict[tuple, deque[int]] = {}
+
+    def add(self, position: int, record: DNSRecord) -> None:
+        self.pending[position] = record
+        content = (record.answer, record.ttl)
+        self.by_content.setdefault(content, deque()).append(position)
+        self.by_content_priority.setdefault(content + (record.priority,), deque()).append(position)
+
+    def take_match(self, desired: DNSRecord) -> Optional[DNSRecord]:
+        '''Consume the first pending record that exactly matches the desired record'''
+        # Priority is only compared if the desired record sets it
+        if desired.priority is None:
+            positions = self.by_content.get((desired.answer, desired.ttl))
+        else:
+            positions = self.by_content_priority.get((desired.answer, desired.ttl, desired.priority))
+
+        while positions:
+            position = positions.popleft()
+            if position in self.pending:
+                return self.pending.pop(position)
+        return None
+
+    def take_last(self) -> Optional[DNSRecord]:
+        '''Consume the last pending record'''
+        if not self.pending:
+            return None
+        return self.pending.pop(next(reversed(self.pending)))
+
+def plan_domain_records(
+    domain: str,
+    desired_records: Iterable[DNSRecord],
+    ignore: Optional['IgnoreMatcher'],
+    existing_records: Iterable[DNSRecord],
+) -> DomainPlan:
+    '''
+    Compute the changes needed to reconcile the existing records of a domain with the desired ones.
+
+    Existing records are indexed by (type, hostname) once, so the plan is computed in roughly linear
+    time. Matching works as follows:
+    * Existing records matching an ignore rule are ignored
+    * Each desired record, in order, consumes the first existing record of the same type and
+      hostname with identical answer, TTL and priority (priority only if the desired record sets it)
+    * Failing that, the last such existing record is updated to match the desired record
+    * Existing records left unconsumed are deleted, desired records left unmatched are created
+    '''
+    plan = DomainPlan(domain=domain)
+
+    ignored = ignore.matches if ignore else None
+
+    # Index the existing records that are up for reconciliation
+    index: dict[tuple[str, str], _Candidates] = {}
+    for position, record in enumerate(existing_records):
+        if ignored is not None and ignored(record):
+            plan.ignores.append(record)
+            continue
+
+        key = (record.type, record.hostname)
+        if key not in index:
+            index[key] = _Candidates()
+        index[key].add(position, record)
+
+    # For each desired record, check if an existing record already matches it. Otherwise, correct
+    # one of the existing records of the same type and hostname, or create it if there are none.
+    for desired_record in desired_records:
+        candidates = index.get((desired_record.type, desired_record.hostname))
+        if candidates is None:
+            plan.creates.append(desired_record)
+            continue
+
+        match = candidates.take_match(desired_record)
+        if match is not None:
+            plan.unchanged.append(match)
+            continue
+
+        mismatching_record = candidates.take_last()
+        if mismatching_record is not None:
+            plan.updates.append(RecordUpdate(
+                existing=mismatching_record,
+                desired=desired_record,
+                reasons=differences(mismatching_record, desired_record),
+            ))
+        else:
+            plan.creates.append(desired_record)
+
+    # Whatever is left over is not used anymore (orphaned), keep the listing order
+    orphaned = []
+    for candidates in index.values():
+        orphaned.extend(candidates.pending.items())
+    orphaned.sort(key=lambda item: item[0])
+    plan.deletes = [record for _, record in orphaned]
+
+    return plan
+
+def apply_plan(provider: 'DNSProvider', plan: DomainPlan, log=None) -> list[ChangeResult]:
+    '''
+    Apply the changes of a plan to the domain using the given provider.
+    Every operation is attempted even if others fail. Raises an error summarizing the failed
+    operations, if any, once everything has been attempted.
+    '''
+    if plan.empty:
+        return []
+
+    results = provider.apply_changes(plan.domain, plan)
+
+    # Providers may turn a delete and a create into an update, which replaces the deleted record
+    reasons = {id(update.existing): update.reasons for update in plan.updates}
+    def update_reasons(result: ChangeResult) -> tuple[str, ...]:
+        return reasons.get(id(result.existing), ('replaced',))
+
+    messages = {
+        CREATE: 'Created DNS record',
+        UPDATE: 'Mismatch detected: updated record',
+        DELETE: 'Deleted orphaned record',
+    }
+    failed = [result for result in results if not result.ok]
+    if metrics.enabled():
+        for result in results:
+            name = 'namectl_record_changes_total' if result.ok else 'namectl_record_change_errors_total'
+            metrics.inc(name, domain=plan.domain, account=provider.account_name, action=result.action)
+            if result.ok and result.action == UPDATE:
+                for reason in update_reasons(result):
+                    metrics.inc('namectl_record_update_reasons_total', domain=plan.domain, reason=reason)
+
+    if log:
+        for result in results:
+            description = result.describe(plan.domain)
+            if result.action == UPDATE:
+                description += f' [{", ".join(update_reasons(result))}]'
+            if result.ok:
+                log.info(f'{messages[result.action]} - {description}')
+            else:
+                log.warning(f'Failed to {result.action} record - {description}\n{result.error}')
+        log.info(f'Churn for {plan.domain}: {plan.churn()}')
+
+    if failed:
+        raise RuntimeError(f'{len(failed)} of {len(results)} change(s) to {plan.domain} failed')
+    return results
@@ -0,0 +1,203 @@
+import sys
+import json
+import time
+import logging
+import threading
+from typing import Optional, TYPE_CHECKING
+from namectl.config import DomainConfig
+from namectl.controller import EXIT_CHANGED, EXIT_FAILED, EXIT_NOOP, plan_desired_records
+from namectl.plan import DomainPlan, apply_plan
+from namectl.state import StateStore, desired_fingerprint, remote_fingerprint
+from namectl.workers import domain_logger, reconcile_concurrently
+
+if TYPE_CHECKING:
+    from namectl.controller import Controller
+
+LOG = logging.getLogger('namectl')
+
+PLAN_VERSION = 1
+'''Version of the saved plan format. Plans with another version are refused'''
+
+MAX_TOUCHED_KEYS = 20
+'''
+Up to how many (type, hostname) keys a plan may change for its staleness to be checked by retrieving
+just those records, if the provider supports it. Zones with more changes are listed in full.
+'''
+
+def plan_domain(domain: DomainConfig) -> dict:
+    '''
+    List the records of a domain and plan the changes needed to reconcile them, without applying
+    anything. Returns the serialized plan along with fingerprints to check its staleness against:
+    * `desired`: the desired state of the domain, which changes with its config and dynamic IPs
+    * `remote`: every record of the zone
+    * `touched`: the records sharing a type and hostname with a record the plan changes
+    '''
+    provider = domain.account.provider
+    existing_records = list(map(provider.canonicalize, provider.list(domain.name)))
+    plan = plan_desired_records(domain, domain.records, existing_records)
+
+    keys = plan.touched_keys()
+    return {
+        **plan.to_json(),
+        'account': domain.account.name,
+        'desired': desired_fingerprint(domain),
+        'remote': remote_fingerprint(existing_records),
+        'touched': remote_fingerprint(record for record in existing_records if (record.type, record.hostname) in keys),
+        'churn': plan.churn(),
+    }
+
+def check_staleness(domain: DomainConfig, entry: dict, state: Optional[StateStore], verify_interval: float) -> Optional[str]:
+    '''
+    Check whether a saved plan still applies to a domain, avoiding listing the zone where possible:
+    1. If the state store holds fresh records for the zone matching the planned zone, the plan holds
+    2. If the plan changes few enough (type, hostname) keys and the provider can retrieve records by
+       type and hostname, only the records of those keys are retrieved and compared
+    3. Otherwise the whole zone is listed and compared
+
+    Returns why the plan is stale, or `None` if it still applies.
+    '''
+    if entry['account'] != domain.account.name or entry['desired'] != desired_fingerprint(domain):
+        return 'its desired state changed since it was planned'
+
+    if state is not None:
+        stored = state.get(domain.name)
+        if stored and stored.account == domain.account.name and stored.fresh(verify_interval) \
+                and stored.remote == entry['remote']:
+            return None
+
+    provider = domain.account.provider
+    keys = DomainPlan.from_json(entry).touched_keys()
+    if provider.can_list_by_name_type() and len(keys) <= MAX_TOUCHED_KEYS:
+        records = []
+        for record_type, hostname in sorted(keys):
+            records.extend(provider.list_by_name_type(domain.name, record_type, hostname))
+        if remote_fingerprint(map(provider.canonicalize, records)) != entry['touched']:
+            return 'the records it changes were changed since it was planned'
+        return None
+
+    if remote_fingerprint(map(provider.canonicalize, provider.list(domain.name))) != entry['remote']:
+        return 'its zone changed since it was planned'
+    return None
+
+def plan_command(controller: 'Controller', output: Optional[str]) -> int:
+    '''
+    Plan the changes for every domain concurrently without applying them, and write the plan as JSON
+    to `output` (or stdout). Returns `EXIT_NOOP` if nothing would change, `EXIT_CHANGED` if something
+    would, and `EXIT_FAILED` if any domain could not be planned.
+    '''
+    args = controller.args
+    current_ipv4, current_ipv6 = controller.ips.discover()
+    try:
+        domains = controller.config.load(current_ipv4, current_ipv6)
+    except Exception as E:
+        LOG.warning(f'An error occured while reading the DNS configuration.\n{E}')
+        return EXIT_FAILED
+    if not domains:
+        LOG.warning('No domain configuration detected!')
+        return EXIT_FAILED
+
+    entries: dict[str, dict] = {}
+    lock = threading.Lock()
+    def plan(domain: DomainConfig) -> None:
+        entry = plan_domain(domain)
+        domain_logger(domain.name).info(f'Planned {domain.name}: {entry["churn"]}')
+        with lock:
+            entries[domain.name] = entry
+
+    errors = reconcile_concurrently(domains, plan, args.workers, args.account_workers)
+    for name, error in errors.items():
+        domain_logger(name).warning(f'An error occured while planning records for {name}\n{error}')
+    controller.config.close()
+
+    document = {
+        'version': PLAN_VERSION,
+        'created': time.time(),
+        'domains': [entries[domain.name] for domain in domains if domain.name in entries],
+        'errors': {name: str(error) for name, error in errors.items()},
+    }
+    if output:
+        with open(output, 'w') as plan_file:
+            json.dump(document, plan_file, indent=2)
+        LOG.info(f'Saved the plan to {output}')
+    else:
+        json.dump(document, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+
+    if errors:
+        return EXIT_FAILED
+    changes = any(entry['creates'] or entry['updates'] or entry['deletes'] for entry in document['domains'])
+    return EXIT_CHANGED if changes else EXIT_NOOP
+
+def apply_command(controller: 'Controller', path: str) -> int:
+    '''
+    Apply a plan saved by `plan_command` exactly as it was planned. Domains whose plan went stale
+    since are skipped. Returns `EXIT_NOOP` if the plan had no changes, `EXIT_CHANGED` if every change
+    was applied, and `EXIT_FAILED` if any domain was stale or failed.
+    '''
+    args = controller.args
+    try:
+        with open(path) as plan_file:
+            document = json.load(plan_file)
+    except (OSError, ValueError) as E:
+        LOG.warning(f'Could not read the plan {path}\n{E}')
+        return EXIT_FAILED
+    if not isinstance(document, dict) or document.get('version') != PLAN_VERSION:
+        LOG.warning(f'The plan {path} was not made by this version of namectl and will not be applied')
+        return EXIT_FAILED
+
+    age = time.time() - document.get('created', 0)
+    LOG.info(f'Applying the plan {path}, made {age:.0f}s ago')
+
+    current_ipv4, current_ipv6 = controller.ips.discover()
+    try:
+        domains = {domain.name: domain for domain in controller.config.load(current_ipv4, current_ipv6)}
+    except Exception as E:
+        LOG.warning(f'An error occured while reading the DNS configuration.\n{E}')
+        return EXIT_FAILED
+
+    entries = {}
+    failed = set(document.get('errors', {}))
+    for entry in document.get('domains', []):
+        if not (entry['creates'] or entry['updates'] or entry['deletes']):
+            continue
+        if entry['domain'] not in domains:
+            LOG.warning(f'The domain {entry["domain"]} of the plan is no longer configured and will not be changed')
+            failed.add(entry['domain'])
+            continue
+        entries[entry['domain']] = entry
+
+    state = controller.state
+    changed = []
+    lock = threading.Lock()
+    def apply(domain: DomainConfig) -> None:
+        log = domain_logger(domain.name)
+        entry = entries[domain.name]
+        stale = check_staleness(domain, entry, state, args.verify_interval)
+        if stale is not None:
+            raise RuntimeError(f'The plan for {domain.name} is stale, as {stale}. Plan again to apply changes to it')
+
+        # The stored records are outdated as soon as anything is changed
+        if state is not None:
+            state.invalidate(domain.name)
+        log.info(f'Applying the planned changes to {domain.name}')
+        apply_plan(domain.account.provider, DomainPlan.from_json(entry), log)
+        with lock:
+            changed.append(domain.name)
+
+    plan_domains = [domains[name] for name in entries]
+    errors = reconcile_concurrently(plan_domains, apply, args.workers, args.account_workers)
+    for name, error in errors.items():
+        domain_logger(name).warning(f'An error occured while applying the plan for {name}\n{error}')
+    failed.update(errors)
+    controller.config.close()
+    if state is not None:
+        state.close()
+
+    if failed:
+        LOG.warning(f'Failed to apply the plan to {len(failed)} domain(s)')
+        return EXIT_FAILED
+    if changed:
+        LOG.info(f'Applied the plan to {len(changed)} domain(s)')
+        return EXIT_CHANGED
+    LOG.info('The plan has no changes to apply')
+    return EXIT_NOOP
@@ -1,11 +1,40 @@
+from importlib import import_module
+from typing import Iterator, Mapping
 from namectl.providers.dns_provider import DNSProvider
-from namectl.providers.porkbun import PorkbunProvider
 
-ALL_PROVIDERS: dict[str, DNSProvider.__class__] = {
-    PorkbunProvider.name: PorkbunProvider,
+PROVIDERS: dict[str, str] = {
+    'porkbun': 'namectl.providers.porkbun.provider:PorkbunProvider',
 }
+'''Where to import the class of every provider from, by provider name'''
+
+class ProviderRegistry(Mapping[str, type]):
+    '''
+    Provider classes by name. A provider is only imported the first time it is looked up, so only
+    the providers the config actually uses are ever loaded.
+    '''
+    def __init__(self, paths: dict[str, str]) -> None:
+        self.paths = paths
+        self.loaded: dict[str, type] = {}
+
+    def __getitem__(self, name: str) -> type:
+        provider = self.loaded.get(name)
+        if provider is None:
+            module, _, attribute = self.paths[name].partition(':')
+            provider = self.loaded[name] = getattr(import_module(module), attribute)
+        return provider
+
+    def __contains__(self, name: object) -> bool:
+        return name in self.paths
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.paths)
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+ALL_PROVIDERS: Mapping[str, type] = ProviderRegistry(PROVIDERS)
 
 __all__ = [
     'DNSProvider',
     'ALL_PROVIDERS',
-]
\ No newline at end of file
+]
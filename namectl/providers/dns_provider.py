@@ -1,8 +1,12 @@
 from abc import abstractmethod, ABC
-from typing import TYPE_CHECKING
+from typing import Iterable, Optional, TYPE_CHECKING
+from namectl.canonical import canonicalize
+from namectl.plan import ChangeResult, CREATE, UPDATE, DELETE
+from namectl.providers.transport import HTTPTransport
 
 if TYPE_CHECKING:
     from namectl.config import DNSRecord
+    from namectl.plan import DomainPlan
 
 class DNSProvider(ABC):
     name: str = ''
@@ -17,8 +21,42 @@ class DNSProvider(ABC):
     This is used to select the account that should be used to reconcile a set of records.
     '''
 
-    def __init__(self, account_name: str) -> None:
+    transport: HTTPTransport = None
+    '''
+    Pooled HTTP transport that should be used for all calls made to the registrar on behalf of this
+    account. Configured from the `http` key of each account.
+    '''
+
+    min_ttl: int = 0
+    '''
+    Lowest TTL the registrar accepts. The registrar raises lower TTLs to this, so desired records
+    are compared as if they had this TTL.
+    '''
+
+    def __init__(self, account_name: str, transport: HTTPTransport = None) -> None:
         self.account_name = account_name
+        self.transport = transport or HTTPTransport()
+        self.transport.is_throttled = self.is_throttled
+        self.transport.labels = {'provider': self.name, 'account': account_name}
+
+    def is_throttled(self, response) -> bool:
+        '''
+        Whether or not a response from the registrar means that the call was throttled.
+        Override this if the registrar signals throttling other than through HTTP 429.
+        '''
+        return response.status_code == 429
+
+    def canonicalize(self, record: 'DNSRecord') -> 'DNSRecord':
+        '''
+        Bring a desired or existing record into canonical form before records are compared, so that
+        representation differences (e.g. trailing dots, IPv6 notation or TXT quoting) don't cause
+        updates. Override this to also account for the quirks of how the registrar stores records.
+        '''
+        return canonicalize(record, self.min_ttl)
+
+    def close(self) -> None:
+        '''Release any resources held by this provider, such as pooled connections'''
+        self.transport.close()
 
     @abstractmethod
     def authenticate(self, credentials: dict) -> None:
@@ -29,13 +67,35 @@ class DNSProvider(ABC):
         raise NotImplementedError(f'DNS provider "{self.name}" must implement method authenticate')
 
     @abstractmethod
-    def list(self, domain: str) -> list['DNSRecord']:
-        '''List all records for a given domain'''
+    def list(self, domain: str) -> Iterable['DNSRecord']:
+        '''
+        List all records for a given domain.
+
+        May return any iterable, which is consumed exactly once. Providers whose registrar paginates
+        should walk every page, preferably yielding records page by page so that large zones are
+        never held in memory in full. A listing that fails partway must raise rather than end early.
+        '''
         raise NotImplementedError(f'DNS provider "{self.name}" must implement method list')
 
+    def list_by_name_type(self, domain: str, type: str, hostname: str) -> 'list[DNSRecord]':
+        '''
+        List the records of a given type and hostname on a domain.
+
+        Optional. Providers whose registrar can retrieve records selectively should implement this,
+        which lets namectl reconcile dynamic records on IP changes without listing the whole domain.
+        '''
+        raise NotImplementedError(f'DNS provider "{self.name}" does not support listing records by name and type')
+
+    def can_list_by_name_type(self) -> bool:
+        '''Whether or not this provider implements `list_by_name_type`'''
+        return type(self).list_by_name_type is not DNSProvider.list_by_name_type
+
     @abstractmethod
-    def create(self, domain: str, record: 'DNSRecord') -> None:
-        '''Create a record on a domain'''
+    def create(self, domain: str, record: 'DNSRecord') -> Optional[str]:
+        '''
+        Create a record on a domain. Returns the ID the registrar assigned to the record, if known.
+        Without it, the state store can't keep track of the record and the domain is listed again.
+        '''
         raise NotImplementedError(f'DNS provider "{self.name}" must implement method create')
 
     @abstractmethod
@@ -47,3 +107,28 @@ class DNSProvider(ABC):
     def delete(self, domain: str, record: 'DNSRecord') -> None:
         '''Delete a record on a domain'''
         raise NotImplementedError(f'DNS provider "{self.name}" must implement method delete')
+
+    def apply_changes(self, domain: str, changeset: 'DomainPlan') -> 'list[ChangeResult]':
+        '''
+        Apply a set of changes to a domain: the updates, deletes and creates of the changeset, in
+        that order. Returns the result of every operation that was performed. Failing operations must
+        not stop the others and are reported through their result rather than raised.
+
+        By default every change is applied one at a time using `update`, `delete` and `create`.
+        Providers can override this to apply changes more efficiently, e.g. by coalescing operations
+        or performing independent operations in parallel.
+        '''
+        results = []
+        for update in changeset.updates:
+            result = ChangeResult(UPDATE, update.desired, existing=update.existing)
+            results.append(result.run(lambda: self.update(domain, update.existing, update.desired)))
+
+        for record in changeset.deletes:
+            result = ChangeResult(DELETE, record)
+            results.append(result.run(lambda: self.delete(domain, record)))
+
+        for record in changeset.creates:
+            result = ChangeResult(CREATE, record)
+            results.append(result.run(lambda: self.create(domain, record)))
+
+        return results
@@ -1,7 +1,12 @@
-import requests
 import os
+from typing import Iterator
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from namectl import deadline
 from namectl.config import DNSRecord
+from namectl.plan import DomainPlan, ChangeResult, CREATE, UPDATE, DELETE
 from namectl.providers import DNSProvider
+from namectl.providers.transport import RegistrarError
 
 class PorkbunProvider(DNSProvider):
     '''
@@ -22,6 +27,14 @@ class PorkbunProvider(DNSProvider):
 
     api_url = 'https://api.porkbun.com/api/json/v3/dns'
 
+    min_ttl = 600
+
+    page_size = 1000
+    '''How many records Porkbun returns at most when listing a domain. Fuller pages mean there may be more'''
+
+    max_parallel_changes = 4
+    '''How many independent changes to a domain are sent to Porkbun at the same time'''
+
     def authenticate(self, credentials: dict) -> None:
         if 'key' not in credentials:
             raise ValueError(f'Account {self.account_name} has not set key in credential config')
@@ -58,20 +71,58 @@ class PorkbunProvider(DNSProvider):
         else:
             self.secret = secret_cfg['value']
 
-    def list(self, domain: str) -> list:
+    def is_throttled(self, response) -> bool:
+        # Porkbun reports exceeded rate limits as errors with a message saying so
+        if response.status_code == 429:
+            return True
+        return response.status_code >= 400 and 'rate limit' in response.text.lower()
+
+    def list(self, domain: str) -> 'Iterator[DNSRecord]':
+        '''
+        Walks the pages of records of the domain, yielding the records of each page as it arrives.
+        Stops at the first page that is short or brings no records that weren't already seen, so a
+        registrar ignoring the offset is not asked for the same page over and over.
+        '''
         read_all_uri = f'{self.api_url}/retrieve/{domain}'
+        seen = set()
+        start = 1
+        while True:
+            data = {
+                'apikey': self.key,
+                'secretapikey': self.secret,
+                'start': str(start),
+                'includeLabels': 'yes',
+            }
+            resp = self.transport.post_json(read_all_uri, data, operation='list')
+            if resp['status'] != 'SUCCESS':
+                raise RegistrarError(resp['message'])
+
+            page = resp['records']
+            new_records = [record for record in page if record['id'] not in seen]
+            seen.update(record['id'] for record in new_records)
+            yield from self.parse_records(domain, new_records)
+
+            if len(page) < self.page_size or not new_records:
+                return
+            start += len(page)
+
+    def list_by_name_type(self, domain: str, type: str, hostname: str) -> 'list[DNSRecord]':
+        read_uri = f'{self.api_url}/retrieveByNameType/{domain}/{type}'
+        if hostname != '':
+            read_uri += f'/{hostname}'
         data = {
             'apikey': self.key,
             'secretapikey': self.secret,
-            'start': '1',
-            'includeLabels': 'yes',
         }
-        resp = requests.post(read_all_uri, json=data).json()
+        resp = self.transport.post_json(read_uri, data, operation='list_by_name_type')
         if resp['status'] != 'SUCCESS':
-            raise RuntimeError(resp['message'])
+            raise RegistrarError(resp['message'])
+
+        return list(self.parse_records(domain, resp['records']))
 
-        all_records = []
-        for record in resp['records']:
+    def parse_records(self, domain: str, records: 'list[dict]') -> 'Iterator[DNSRecord]':
+        '''Marshal the records returned by the Porkbun API into DNSRecords'''
+        for record in records:
             hostname = ''
             if record['name'] != domain:
                 hostname = record['name'].split(domain)[0][:-1]
@@ -83,16 +134,14 @@ class PorkbunProvider(DNSProvider):
             priority = None
             if 'prio' in record and record['prio'] is not None:
                 priority = int(record.get('prio'))
-            all_records.append(DNSRecord(
+            yield DNSRecord(
                 hostname=hostname,
                 type=record.get('type'),
                 answer=record.get('content'),
                 ttl=int(record.get('ttl')),
                 priority=priority,
-                data={'id': record['id']},
-            ))
-
-        return all_records
+                id=record['id'],
+            )
 
     def create(self, domain: str, record: DNSRecord) -> str:
         '''Returns the ID of the created record'''
@@ -106,17 +155,18 @@ class PorkbunProvider(DNSProvider):
         }
         if record.hostname != '':
             data['name'] = record.hostname
-        if record.priority != '':
+        if record.priority is not None:
             data['prio'] = str(record.priority)
 
-        resp = requests.post(create_uri, json=data).json()
+        # Creating is not idempotent, a blind retry could create the record twice
+        resp = self.transport.post_json(create_uri, data, idempotent=False, operation='create')
         if resp['status'] != 'SUCCESS':
-            raise RuntimeError(resp['message'])
+            raise RegistrarError(resp['message'])
 
         return resp['id']
 
     def update(self, domain: str, record: DNSRecord, new_record: DNSRecord) -> None:
-        record_id = record.data['id']
+        record_id = record.id
         edit_uri = f'{self.api_url}/edit/{domain}/{record_id}'
         data = {
             'apikey': self.key,
@@ -126,15 +176,17 @@ class PorkbunProvider(DNSProvider):
             'content': new_record.answer,
             'ttl': str(new_record.ttl),
         }
-        if record.priority != '':
-            data['prio'] = str(record.priority)
+        # Keep the existing priority unless a new one is desired
+        priority = new_record.priority if new_record.priority is not None else record.priority
+        if priority is not None:
+            data['prio'] = str(priority)
 
-        resp = requests.post(edit_uri, json=data).json()
+        resp = self.transport.post_json(edit_uri, data, operation='update')
         if resp['status'] != 'SUCCESS':
-            raise RuntimeError(resp['message'])
+            raise RegistrarError(resp['message'])
 
     def delete(self, domain: str, record: DNSRecord) -> None:
-        record_id = record.data['id']
+        record_id = record.id
         delete_uri = f'{self.api_url}/delete/{domain}/{record_id}'
         data = {
             'apikey': self.key,
@@ -142,6 +194,54 @@ class PorkbunProvider(DNSProvider):
             'start': '1',
             'includeLabels': 'yes',
         }
-        resp = requests.post(delete_uri, json=data).json()
+        resp = self.transport.post_json(delete_uri, data, operation='delete')
         if resp['status'] != 'SUCCESS':
-            raise RuntimeError(resp['message'])
+            raise RegistrarError(resp['message'])
+
+    def apply_changes(self, domain: str, changeset: DomainPlan) -> 'list[ChangeResult]':
+        '''
+        Applies the changes in three phases: updates, then deletes, then creates. Within each phase,
+        changes are independent of each other and are sent in parallel.
+
+        A delete and a create of the same record type are coalesced into a single edit of the deleted
+        record, which is performed in the create phase. This is only done if nothing else is created
+        on the hostname of the deleted record, since that record lingers until the edit.
+        '''
+        created_hostnames = Counter(record.hostname for record in changeset.creates)
+        reusable = defaultdict(deque)
+        for record in changeset.deletes:
+            if created_hostnames[record.hostname] == 0:
+                reusable[record.type].append(record)
+
+        edits = []
+        creates = []
+        for record in changeset.creates:
+            if reusable[record.type]:
+                edits.append((reusable[record.type].popleft(), record))
+            else:
+                creates.append(record)
+        edited = {id(existing) for existing, _ in edits}
+        deletes = [record for record in changeset.deletes if id(record) not in edited]
+
+        updates = [(update.existing, update.desired) for update in changeset.updates]
+        phases = [
+            [ChangeResult(UPDATE, desired, existing=existing) for existing, desired in updates],
+            [ChangeResult(DELETE, record) for record in deletes],
+            [ChangeResult(UPDATE, desired, existing=existing) for existing, desired in edits] + \
+            [ChangeResult(CREATE, record) for record in creates],
+        ]
+
+        def run(result: ChangeResult) -> ChangeResult:
+            if result.action == UPDATE:
+                return result.run(lambda: self.update(domain, result.existing, result.record))
+            if result.action == DELETE:
+                return result.run(lambda: self.delete(domain, result.record))
+            return result.run(lambda: self.create(domain, result.record))
+
+        # Changes run on other threads, but must respect the deadline of the domain
+        run = deadline.propagate(run)
+        results = []
+        with ThreadPoolExecutor(max_workers=self.max_parallel_changes, thread_name_prefix='namectl-porkbun') as pool:
+            for phase in phases:
+                results.extend(pool.map(run, phase))
+        return results
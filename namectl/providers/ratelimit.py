@@ -0,0 +1,139 @@
+import time
+import logging
+import threading
+from dataclasses import dataclass, fields
+from typing import Optional
+
+LOG = logging.getLogger('namectl')
+
+@dataclass
+class RateLimitConfig:
+    '''
+    Configuration for the rate limiter of an account, read from `accounts[].rate_limit`.
+
+    ```yaml
+    rate_limit:
+      rate: 10       # calls per second that may be made to the registrar
+      burst: 20      # how many calls may be made at once after a quiet period
+      min_rate: 0.5  # the rate never drops below this while backing off
+      recovery: 0.05 # fraction of the configured rate regained for every successful call
+    ```
+    '''
+    rate: float = 10.0
+    burst: int = 20
+    min_rate: float = 0.5
+    recovery: float = 0.05
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'RateLimitConfig':
+        '''Read the rate limit configuration from the `rate_limit` key of an account'''
+        known = {f.name: f.type for f in fields(cls)}
+        for key, value in config.items():
+            if key not in known:
+                raise ValueError(f'Unknown rate limit option "{key}"')
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                raise ValueError(f'Rate limit option "{key}" must be a positive number, got "{value}"')
+            if known[key] is int and not isinstance(value, int):
+                raise ValueError(f'Rate limit option "{key}" must be an integer, got "{value}"')
+        config = cls(**config)
+        if config.min_rate > config.rate:
+            raise ValueError('Rate limit option "min_rate" must not exceed "rate"')
+        return config
+
+class RateLimiter:
+    '''
+    Token bucket limiting the calls made to a registrar on behalf of one account, with adaptive
+    throttling.
+
+    Every call takes a token, and tokens are replenished at the current rate up to `burst` tokens.
+    When the registrar throttles a call, the rate is halved and calls are paused for a moment. Other
+    errors reduce the rate more gently. Every successful call then gradually restores the rate
+    towards the configured rate.
+    '''
+    def __init__(self, config: RateLimitConfig = None) -> None:
+        self.config = config or RateLimitConfig()
+        self.rate = self.config.rate
+        self.tokens = float(self.config.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+        self.calls = 0
+        '''How many calls have been let through'''
+
+        self.throttled = 0
+        '''How many calls were throttled by the registrar'''
+
+        self.errors = 0
+        '''How many calls failed with other errors'''
+
+        self.waited = 0.0
+        '''Total seconds calls have spent waiting for the limiter'''
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.config.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, timeout: Optional[float] = None) -> Optional[float]:
+        '''
+        Wait until a call may be made. Returns how many seconds were spent waiting, or `None` without
+        waiting any longer as soon as it's clear that no call may be made within `timeout` seconds.
+        '''
+        started = time.monotonic()
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    self.calls += 1
+                    waited = now - started
+                    self.waited += waited
+                    return waited
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            if timeout is not None and now + delay > started + timeout:
+                return None
+            time.sleep(delay)
+
+    def on_success(self) -> None:
+        '''Report that a call succeeded, gradually restoring the rate'''
+        with self.lock:
+            if self.rate < self.config.rate:
+                self.rate = min(self.config.rate, self.rate + self.config.rate * self.config.recovery)
+
+    def on_throttle(self, retry_after: Optional[float] = None) -> None:
+        '''Report that the registrar throttled a call, halving the rate and pausing for a moment'''
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            self.throttled += 1
+            self.rate = max(self.config.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.paused_until = max(self.paused_until, now + (retry_after or 1 / self.rate))
+            rate = self.rate
+        LOG.warning(f'Throttled by the registrar, reducing the call rate to {rate:.2f}/s')
+
+    def on_error(self) -> None:
+        '''Report that a call failed for other reasons, reducing the rate slightly'''
+        with self.lock:
+            self.errors += 1
+            self.rate = max(self.config.min_rate, self.rate * 0.8)
+
+    def snapshot(self) -> dict:
+        '''Get the current state of the limiter, for monitoring'''
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+            return {
+                'rate': self.rate,
+                'configured_rate': self.config.rate,
+                'tokens': self.tokens,
+                'paused_for': max(0.0, self.paused_until - now),
+                'calls': self.calls,
+                'throttled': self.throttled,
+                'errors': self.errors,
+                'waited': self.waited,
+            }
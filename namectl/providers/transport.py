@@ -0,0 +1,209 @@
+import sys
+import time
+import random
+import logging
+import threading
+from dataclasses import dataclass, fields
+from typing import Callable, Optional, TYPE_CHECKING
+from namectl import deadline, metrics
+from namectl.providers.ratelimit import RateLimiter
+
+if TYPE_CHECKING:
+    import requests
+
+LOG = logging.getLogger('namectl')
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+'''HTTP statuses that are considered transient and worth retrying'''
+
+class RegistrarError(RuntimeError):
+    '''Raised when the registrar responds with an error, or with something that isn't a valid response'''
+
+def is_registrar_failure(error: BaseException) -> bool:
+    '''
+    Whether or not an error is the fault of the registrar or the network, as opposed to e.g. a bug,
+    a misconfiguration or running out of time
+    '''
+    if isinstance(error, RegistrarError):
+        return True
+    # requests is only imported once a call is made, so an error can't come from it if it isn't
+    requests = sys.modules.get('requests')
+    return requests is not None and isinstance(error, requests.exceptions.RequestException)
+
+@dataclass
+class TransportConfig:
+    '''
+    Configuration for the HTTP transport of an account, read from `accounts[].http`.
+
+    ```yaml
+    http:
+      connect_timeout: 5 # seconds to wait for a connection to be established
+      read_timeout: 30   # seconds to wait for the registrar to respond
+      retries: 3         # how many times to retry a request that failed transiently
+      backoff: 0.5       # base delay in seconds of the exponential backoff between retries
+      max_backoff: 10    # upper bound in seconds on the delay between retries
+      pool_size: 10      # maximum number of kept-alive connections to the registrar
+    ```
+    '''
+    connect_timeout: float = 5.0
+    read_timeout: float = 30.0
+    retries: int = 3
+    backoff: float = 0.5
+    max_backoff: float = 10.0
+    pool_size: int = 10
+
+    @classmethod
+    def from_config(cls, config: dict) -> 'TransportConfig':
+        '''Read the transport configuration from the `http` key of an account'''
+        known = {f.name: f.type for f in fields(cls)}
+        for key, value in config.items():
+            if key not in known:
+                raise ValueError(f'Unknown HTTP option "{key}"')
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                raise ValueError(f'HTTP option "{key}" must be a non-negative number, got "{value}"')
+            if known[key] is int and not isinstance(value, int):
+                raise ValueError(f'HTTP option "{key}" must be an integer, got "{value}"')
+        if config.get('pool_size', 1) < 1:
+            raise ValueError('HTTP option "pool_size" must be at least 1')
+        return cls(**config)
+
+def retry_after(resp: 'requests.Response') -> Optional[float]:
+    '''Get the number of seconds the Retry-After header of a response asks to wait, if any'''
+    try:
+        return max(0.0, float(resp.headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return None
+
+class HTTPTransport:
+    '''
+    Pooled HTTP transport shared by all calls a provider makes on behalf of one account.
+
+    Connections are kept alive and reused between calls, every request has a connect and read
+    timeout, and requests that fail transiently are retried with jittered exponential backoff.
+    If a rate limiter is given, every request (including retries) waits for it first, and the
+    outcome of every request is reported back to it.
+    '''
+    def __init__(self, config: TransportConfig = None, limiter: RateLimiter = None) -> None:
+        self.config = config or TransportConfig()
+        self.limiter = limiter
+
+        self.is_throttled: Callable[['requests.Response'], bool] = lambda resp: resp.status_code == 429
+        '''Whether or not a response means the registrar throttled the request. Set by the provider'''
+
+        self.labels: dict[str, str] = {}
+        '''Labels identifying the provider and account in the metrics of every request. Set by the provider'''
+
+        self._session: Optional['requests.Session'] = None
+        self.session_lock = threading.Lock()
+
+    @property
+    def session(self) -> 'requests.Session':
+        '''
+        The pooled session, created on first use. `requests` is only imported then, so that runs that
+        never call the registrar don't pay for importing it.
+        '''
+        with self.session_lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.config.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._session = session
+            return self._session
+
+    def close(self) -> None:
+        '''Close all pooled connections'''
+        if self._session is not None:
+            self._session.close()
+
+    def backoff(self, attempt: int) -> float:
+        '''Get the delay before retry number `attempt` (0-indexed), using full jitter'''
+        ceiling = min(self.config.max_backoff, self.config.backoff * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    def post(self, url: str, json: dict, idempotent: bool = True, operation: str = 'post') -> 'requests.Response':
+        '''
+        POST a JSON body to the given URL, retrying transient failures.
+
+        Requests that are not idempotent are only retried if they certainly never reached the
+        registrar, i.e. the connection could not be established or the registrar throttled the
+        request. Everything else is only retried if `idempotent` is set. `operation` names the
+        call in metrics.
+
+        Within a deadline (see `namectl.deadline`), timeouts are cut short to fit the time left,
+        and `DeadlineExceeded` is raised instead of starting an attempt or retry that can't finish,
+        or of waiting for the rate limiter past the deadline.
+        '''
+        session = self.session
+        import requests
+
+        attempt = 0
+        while True:
+            # Don't wait for the limiter (e.g. a long Retry-After pause) past the deadline
+            if self.limiter and self.limiter.acquire(deadline.check(f'Calling {url}')) is None:
+                raise deadline.DeadlineExceeded(f'Calling {url} ran out of time waiting for the rate limit')
+            timeout = (self.config.connect_timeout, self.config.read_timeout)
+            left = deadline.check(f'Calling {url}')
+            if left is not None:
+                timeout = (min(timeout[0], left), min(timeout[1], left))
+            started = time.perf_counter()
+            try:
+                resp = session.post(url, json=json, timeout=timeout)
+            except requests.exceptions.ConnectTimeout:
+                self.report(None, operation, started)
+                deadline.check(f'Calling {url}')
+                if attempt >= self.config.retries:
+                    raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.report(None, operation, started)
+                deadline.check(f'Calling {url}')
+                if not idempotent or attempt >= self.config.retries:
+                    raise
+            else:
+                throttled = self.report(resp, operation, started)
+                # Throttled requests were never processed, so they are always safe to retry
+                retryable = throttled or (resp.status_code in RETRY_STATUSES and idempotent)
+                if not retryable or attempt >= self.config.retries:
+                    return resp
+
+            delay = self.backoff(attempt)
+            left = deadline.remaining()
+            if left is not None and left <= delay:
+                raise deadline.DeadlineExceeded(f'Calling {url} ran out of time to retry')
+            attempt += 1
+            LOG.debug(f'Transient failure calling {url}, '
+                      f'retrying in {delay:.2f}s ({attempt}/{self.config.retries})')
+            time.sleep(delay)
+
+    def report(self, resp: Optional['requests.Response'], operation: str, started: float) -> bool:
+        '''
+        Report the outcome of a request to the rate limiter and metrics, `None` meaning the request
+        failed without a response. Returns whether or not the request was throttled.
+        '''
+        throttled = resp is not None and self.is_throttled(resp)
+        if metrics.enabled():
+            outcome = 'throttled' if throttled else 'error' if resp is None else str(resp.status_code)
+            metrics.observe('namectl_api_call_seconds', time.perf_counter() - started,
+                            operation=operation, **self.labels)
+            metrics.inc('namectl_api_calls_total', operation=operation, outcome=outcome, **self.labels)
+
+        if self.limiter is None:
+            return throttled
+
+        if throttled:
+            self.limiter.on_throttle(retry_after(resp))
+        elif resp is None or resp.status_code >= 500:
+            self.limiter.on_error()
+        else:
+            self.limiter.on_success()
+        return throttled
+
+    def post_json(self, url: str, json: dict, idempotent: bool = True, operation: str = 'post') -> dict:
+        '''POST a JSON body to the given URL and decode the JSON response'''
+        resp = self.post(url, json, idempotent=idempotent, operation=operation)
+        try:
+            return resp.json()
+        except ValueError:
+            raise RegistrarError(f'Got an invalid response from the registrar (HTTP {resp.status_code})')
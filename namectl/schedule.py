@@ -0,0 +1,112 @@
+import heapq
+import random
+import time
+from typing import Optional
+
+class Scheduler:
+    '''
+    Keeps track of when each domain is next due for a periodic resync, using a heap ordered by the
+    time each domain is due.
+
+    Every domain runs on a fixed grid of its own interval. The grid of each domain is anchored at a
+    random point when the domain is first scheduled, so that domains sharing an interval are spread
+    out instead of all becoming due at once. Every run is additionally delayed by a small random
+    jitter, which is not carried over to the next run, so the grid never drifts. If a resync overruns
+    past one or more grid points, those are skipped rather than run back to back.
+    '''
+    def __init__(self, jitter: float = 0.1, clock=time.monotonic, rng: random.Random = None) -> None:
+        self.jitter = jitter
+        '''Fraction of its interval that every run of a domain is randomly delayed by, at most'''
+
+        self.clock = clock
+        self.random = rng or random.Random()
+
+        self.heap: list[tuple[float, int, str]] = []
+        '''Entries of (due, sequence number, domain). Entries are stale if their sequence number is outdated'''
+
+        self.entries: dict[str, tuple[float, float, int]] = {}
+        '''The (interval, grid anchor, sequence number) of every scheduled domain'''
+
+        self.sequence = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    def push(self, name: str, interval: float, anchor: float, now: float) -> None:
+        '''Schedule a domain for the first point on its grid after `now`, or the anchor if that is later'''
+        periods = max(0, int((now - anchor) // interval) + 1)
+        due = anchor + periods * interval + self.random.uniform(0, self.jitter * interval)
+        self.sequence += 1
+        self.entries[name] = (interval, anchor, self.sequence)
+        heapq.heappush(self.heap, (due, self.sequence, name))
+
+        # Drop stale entries once they make up most of the heap
+        if len(self.heap) > 2 * len(self.entries) + 16:
+            self.heap = [item for item in self.heap if self.current(item)]
+            heapq.heapify(self.heap)
+
+    def sync(self, intervals: dict[str, float]) -> None:
+        '''
+        Bring the schedule in line with the given domains and their intervals. New domains and domains
+        whose interval changed get a new randomly placed grid, removed domains are unscheduled.
+        '''
+        now = self.clock()
+        for name in list(self.entries):
+            if name not in intervals:
+                del self.entries[name]
+
+        for name, interval in intervals.items():
+            entry = self.entries.get(name)
+            if entry is not None and entry[0] == interval:
+                continue
+            # First run somewhere between half an interval and one and a half intervals from now
+            anchor = now + self.random.uniform(0.5, 1.5) * interval
+            self.push(name, interval, anchor, now)
+
+    def current(self, item: tuple[float, int, str]) -> bool:
+        entry = self.entries.get(item[2])
+        return entry is not None and entry[2] == item[1]
+
+    def next_due(self) -> Optional[float]:
+        '''Get the time the next domain is due, if any domains are scheduled'''
+        while self.heap and not self.current(self.heap[0]):
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self) -> set[str]:
+        '''
+        Take every domain that is due now, scheduling each one for its next grid point. Pass them to
+        `reschedule` once they have been resynced, to skip any grid points the resync overran.
+        '''
+        now = self.clock()
+        due = set()
+        while self.heap and self.heap[0][0] <= now:
+            item = heapq.heappop(self.heap)
+            if self.current(item):
+                due.add(item[2])
+
+        for name in due:
+            interval, anchor, _ = self.entries[name]
+            self.push(name, interval, anchor, now)
+        return due
+
+    def retry(self, names: set[str], delay: float) -> None:
+        '''Run the given domains once in `delay` seconds, after which they resume their grid'''
+        due = self.clock() + delay
+        for name in names:
+            if name in self.entries:
+                interval, anchor, _ = self.entries[name]
+                self.sequence += 1
+                self.entries[name] = (interval, anchor, self.sequence)
+                heapq.heappush(self.heap, (due, self.sequence, name))
+
+    def reschedule(self, names: set[str]) -> None:
+        '''Move the next run of the given domains to their next grid point from now, skipping overruns'''
+        now = self.clock()
+        for name in names:
+            if name in self.entries:
+                interval, anchor, _ = self.entries[name]
+                self.push(name, interval, anchor, now)
@@ -0,0 +1,252 @@
+import os
+import time
+import socket
+import sqlite3
+import hashlib
+import logging
+import threading
+from abc import abstractmethod, ABC
+from typing import Iterable, Optional
+from namectl.events import SHARD_CHANGED, TriggerQueue, Watcher
+
+LOG = logging.getLogger('namectl')
+
+def score(instance: str, domain: str) -> int:
+    return int.from_bytes(hashlib.blake2b(f'{instance}\0{domain}'.encode(), digest_size=8).digest(), 'big')
+
+def owner(domain: str, instances: Iterable[str]) -> Optional[str]:
+    '''
+    Pick the instance that should own a domain with rendezvous (highest random weight) hashing.
+    When an instance joins or leaves, only the domains it gains or loses change owner.
+    '''
+    return max(instances, key=lambda instance: score(instance, domain), default=None)
+
+def default_instance_id() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}'
+
+class LeaseBackend(ABC):
+    '''
+    Shared store of the leases through which namectl instances coordinate. Instances hold a
+    membership lease for as long as they are alive, and a lease on every domain they reconcile.
+    Leases are timestamped with the wall clock, as they are compared across processes and hosts.
+    '''
+    @abstractmethod
+    def join(self, instance: str, expires: float) -> list[str]:
+        '''Take or renew the membership lease of an instance. Returns every instance with an unexpired lease'''
+
+    @abstractmethod
+    def acquire(self, instance: str, domains: Iterable[str], expires: float) -> set[str]:
+        '''
+        Take or renew the leases on the given domains for an instance, skipping domains another
+        instance holds an unexpired lease on. Returns the domains the instance now holds.
+        '''
+
+    @abstractmethod
+    def release(self, instance: str, domains: Iterable[str] = None) -> None:
+        '''Release the leases of an instance on the given domains, or on everything including its membership'''
+
+    def close(self) -> None:
+        pass
+
+class SQLiteLeaseBackend(LeaseBackend):
+    '''
+    Lease backend keeping leases in a SQLite database, for instances sharing a filesystem.
+    SQLite's file locking makes taking leases atomic across processes.
+    '''
+    SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS members (instance TEXT PRIMARY KEY, expires REAL NOT NULL);
+    CREATE TABLE IF NOT EXISTS leases (domain TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL);
+    '''
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=10)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(self.SCHEMA)
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+    def join(self, instance: str, expires: float) -> list[str]:
+        now = time.time()
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.execute('DELETE FROM members WHERE expires <= ?', (now,))
+                self.db.execute('INSERT OR REPLACE INTO members VALUES (?, ?)', (instance, expires))
+                members = [row[0] for row in self.db.execute('SELECT instance FROM members')]
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        return members
+
+    def acquire(self, instance: str, domains: Iterable[str], expires: float) -> set[str]:
+        now = time.time()
+        domains = set(domains)
+        with self.lock:
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                self.db.executemany(
+                    'INSERT INTO leases VALUES (?, ?, ?) ON CONFLICT (domain) DO UPDATE '
+                    'SET owner = excluded.owner, expires = excluded.expires '
+                    'WHERE leases.owner = excluded.owner OR leases.expires <= ?',
+                    [(domain, instance, expires, now) for domain in domains],
+                )
+                held = {row[0] for row in self.db.execute(
+                    'SELECT domain FROM leases WHERE owner = ? AND expires > ?', (instance, now))}
+                self.db.execute('COMMIT')
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+        return held & domains
+
+    def release(self, instance: str, domains: Iterable[str] = None) -> None:
+        with self.lock:
+            if domains is None:
+                self.db.execute('DELETE FROM leases WHERE owner = ?', (instance,))
+                self.db.execute('DELETE FROM members WHERE instance = ?', (instance,))
+            else:
+                self.db.executemany('DELETE FROM leases WHERE domain = ? AND owner = ?',
+                                    [(domain, instance) for domain in domains])
+
+class Shard:
+    '''
+    The share of the domains owned by this namectl instance, when domains are sharded across
+    several instances sharing a config.
+
+    Every live instance is assigned domains by rendezvous hashing over the live instances, so that
+    instances joining or leaving move as few domains as possible. Assignment alone can't prevent two
+    instances from briefly disagreeing about who owns a domain, so an instance only reconciles the
+    domains it also holds a lease on, which it only gets once the previous owner released it or
+    let it expire. An instance that dies stops renewing its leases, so its domains fail over to the
+    other instances within `lease_ttl` seconds plus one renewal period.
+    '''
+    def __init__(self, backend: LeaseBackend, instance: str = None, lease_ttl: float = 30.0) -> None:
+        self.backend = backend
+        self.instance = instance or default_instance_id()
+        self.lease_ttl = lease_ttl
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+        self.domains: frozenset[str] = frozenset()
+        '''Every domain in the config'''
+
+        self.members: list[str] = []
+        '''The live instances, as of the last refresh'''
+
+        self.owned: frozenset[str] = frozenset()
+        '''The domains this instance holds a lease on'''
+
+        self.valid_until = 0.0
+        '''Monotonic time until which the leases in `owned` are known to be held'''
+
+        self.gained: set[str] = set()
+        '''Domains gained since the controller last took them, see `take_gained`'''
+
+        self.busy: set[str] = set()
+        '''Domains that are being reconciled, see `begin`'''
+
+    def owns(self, domain: str) -> bool:
+        '''Whether or not this instance may reconcile a domain right now'''
+        with self.lock:
+            return domain in self.owned and time.monotonic() < self.valid_until
+
+    def begin(self, domain: str) -> bool:
+        '''
+        Start reconciling a domain, if this instance owns it. The lease on the domain is kept until
+        `end` is called, even if the domain is assigned to another instance in the meantime.
+        '''
+        with self.lock:
+            if domain not in self.owned or time.monotonic() >= self.valid_until:
+                return False
+            self.busy.add(domain)
+            return True
+
+    def end(self, domain: str) -> None:
+        with self.lock:
+            self.busy.discard(domain)
+
+    def refresh(self, domains: Iterable[str] = None) -> set[str]:
+        '''
+        Renew the membership and leases of this instance, taking the leases of the domains assigned
+        to it and releasing the others. `domains` updates the set of configured domains.
+        Returns the domains this instance gained.
+        '''
+        with self.refresh_lock:
+            if domains is not None:
+                self.domains = frozenset(domains)
+
+            started = time.monotonic()
+            expires = time.time() + self.lease_ttl
+            members = self.backend.join(self.instance, expires)
+            assigned = {domain for domain in self.domains if owner(domain, members) == self.instance}
+
+            # Domains that are being reconciled are only handed over once they are done
+            with self.lock:
+                kept = assigned | (self.owned & self.busy)
+                released = self.owned - kept
+                if released:
+                    self.owned = self.owned - released
+            if released:
+                self.backend.release(self.instance, released)
+            held = self.backend.acquire(self.instance, kept, expires)
+
+            with self.lock:
+                gained = held - self.owned
+                lost = self.owned - held
+                self.owned = frozenset(held)
+                self.valid_until = started + self.lease_ttl
+                self.gained = (self.gained | gained) & assigned
+
+            if sorted(members) != sorted(self.members):
+                LOG.info(f'Sharding across {len(members)} instance(s), {self.instance} is assigned '
+                         f'{len(assigned)} of {len(self.domains)} domain(s)')
+            self.members = members
+            if gained:
+                LOG.info(f'Took ownership of {len(gained)} domain(s)')
+            if released or lost:
+                LOG.info(f'Handed over {len(released | lost)} domain(s)')
+            if not assigned <= held:
+                LOG.info(f'Waiting for other instances to release {len(assigned - held)} domain(s)')
+            return gained
+
+    def take_gained(self) -> set[str]:
+        '''Take the domains gained since the last call, which should be reconciled right away'''
+        with self.lock:
+            gained, self.gained = self.gained, set()
+        return gained
+
+    def close(self) -> None:
+        '''Release every lease of this instance, so that other instances take over right away'''
+        with self.lock:
+            self.owned = frozenset()
+        try:
+            self.backend.release(self.instance)
+        except Exception as E:
+            LOG.warning(f'Failed to release the leases of {self.instance}\n{E}')
+
+class LeaseWatcher(Watcher):
+    '''Renews the leases of a shard in the background, firing a trigger when it gains domains'''
+    def __init__(self, shard: Shard, triggers: TriggerQueue, period: float) -> None:
+        super().__init__(triggers, 'namectl-leases')
+        self.shard = shard
+        self.period = period
+
+    def run(self) -> None:
+        while not self.stopped.wait(self.period):
+            try:
+                gained = self.shard.refresh()
+            except Exception as E:
+                LOG.warning(f'Failed to renew the leases of {self.shard.instance}\n{E}')
+                continue
+            if gained:
+                self.triggers.fire(SHARD_CHANGED)
+
+def watch_leases(shard: Shard, triggers: TriggerQueue) -> LeaseWatcher:
+    '''Renew the leases of a shard three times per lease TTL'''
+    watcher = LeaseWatcher(shard, triggers, shard.lease_ttl / 3)
+    watcher.start()
+    return watcher
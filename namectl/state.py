@@ -0,0 +1,194 @@
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from dataclasses import dataclass
+from typing import Iterable, Optional
+from namectl.config import DNSRecord, DomainConfig
+from namectl.plan import ChangeResult, DomainPlan, CREATE, UPDATE
+
+LOG = logging.getLogger('namectl')
+
+SCHEMA_VERSION = 2
+'''Version of the state store schema. Stores with another version are discarded'''
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS domains (
+    name TEXT PRIMARY KEY,
+    account TEXT NOT NULL,
+    desired TEXT NOT NULL,
+    remote TEXT NOT NULL,
+    records TEXT NOT NULL,
+    verified REAL NOT NULL,
+    applied REAL NOT NULL
+)
+'''
+
+def record_key(record: DNSRecord) -> tuple:
+    return (record.hostname, record.type, record.answer, record.ttl, record.priority)
+
+def desired_fingerprint(domain: DomainConfig) -> str:
+    '''
+    Fingerprint of the desired state of a domain, covering its records (including the current answer
+    of dynamic records), its ignore rules and its account
+    '''
+    state = (
+        domain.account.name,
+        [record_key(record) for record in domain.records],
+        [rule.key() for rule in domain.ignored_records],
+    )
+    return hashlib.sha256(json.dumps(state).encode()).hexdigest()
+
+def remote_fingerprint(records: Iterable[DNSRecord]) -> str:
+    '''Fingerprint of the content of the records of a zone, independent of their order'''
+    keys = sorted(json.dumps(record_key(record)) for record in records)
+    return hashlib.sha256('\n'.join(keys).encode()).hexdigest()
+
+@dataclass
+class DomainState:
+    '''The last known state of a domain at the registrar'''
+    name: str
+    '''The name of the domain'''
+
+    account: str
+    '''The account the domain was reconciled with'''
+
+    desired: str
+    '''Fingerprint of the desired state that was last applied to the domain'''
+
+    remote: str
+    '''Fingerprint of the records of the domain'''
+
+    records: list[DNSRecord]
+    '''The records of the domain, including their IDs at the registrar'''
+
+    verified: float
+    '''Unix time at which the records were last listed from the registrar'''
+
+    applied: float
+    '''Unix time at which the desired state was last applied'''
+
+    def fresh(self, verify_interval: float, now: float = None) -> bool:
+        '''Whether or not the records were verified against the registrar recently enough to be trusted'''
+        return (now or time.time()) - self.verified < verify_interval
+
+def applied_records(plan: DomainPlan, results: list[ChangeResult]) -> Optional[list[DNSRecord]]:
+    '''
+    Work out the records of a domain after a plan was fully applied to it. Every existing record ends
+    up in the plan, so the records left alone are known without keeping the listing around.
+    Returns `None` if the provider did not report the ID of a created record, in which case the
+    resulting records can't be known without listing them.
+    '''
+    records = plan.unchanged + plan.ignores
+    for result in results:
+        if result.action == UPDATE:
+            existing_record = result.existing
+            priority = result.record.priority if result.record.priority is not None else existing_record.priority
+            records.append(DNSRecord(
+                hostname=result.record.hostname,
+                type=existing_record.type,
+                answer=result.record.answer,
+                ttl=result.record.ttl,
+                priority=priority,
+                id=existing_record.id,
+            ))
+        elif result.action == CREATE:
+            if result.value is None:
+                return None
+            records.append(DNSRecord(
+                hostname=result.record.hostname,
+                type=result.record.type,
+                answer=result.record.answer,
+                ttl=result.record.ttl,
+                priority=result.record.priority,
+                id=result.value,
+            ))
+
+    return records
+
+class StateStore:
+    '''
+    On-disk store of the last known state of every domain at the registrar, backed by SQLite.
+
+    For every domain it keeps the records last seen at the registrar (including their IDs), a
+    fingerprint of the desired state that was last applied and when the records were last listed.
+    This lets the controller skip domains whose desired state has not changed since it was applied,
+    and plan changes against the stored records instead of listing the zone, until the records are
+    due to be verified again. The store survives restarts, so namectl resumes where it left off.
+
+    A domain is removed from the store before changes are applied to it, and only stored again
+    once every change succeeded. A failed or interrupted reconciliation therefore always leads to
+    a full listing next time.
+    '''
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+
+        version = self.db.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            if version != 0:
+                LOG.info(f'Discarding state store {path} with outdated schema version {version}')
+            self.db.execute('DROP TABLE IF EXISTS domains')
+            self.db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        self.db.execute(SCHEMA)
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+    def get(self, name: str) -> Optional[DomainState]:
+        '''Get the stored state of a domain, if any'''
+        with self.lock:
+            row = self.db.execute(
+                'SELECT name, account, desired, remote, records, verified, applied FROM domains WHERE name = ?',
+                (name,),
+            ).fetchone()
+        if row is None:
+            return None
+
+        name, account, desired, remote, records, verified, applied = row
+        try:
+            records = [
+                DNSRecord(hostname=hostname, type=type, answer=answer, ttl=ttl, priority=priority, id=id)
+                for hostname, type, answer, ttl, priority, id in json.loads(records)
+            ]
+        except (ValueError, TypeError) as E:
+            LOG.warning(f'Discarding corrupt stored state of {name}\n{E}')
+            self.invalidate(name)
+            return None
+        return DomainState(name, account, desired, remote, records, verified, applied)
+
+    def save(self, domain: DomainConfig, records: list[DNSRecord], verified: float) -> None:
+        '''Store the records of a domain after its desired state was applied to them'''
+        serialized = json.dumps([
+            (record.hostname, record.type, record.answer, record.ttl, record.priority, record.id)
+            for record in records
+        ])
+        row = (
+            domain.name,
+            domain.account.name,
+            desired_fingerprint(domain),
+            remote_fingerprint(records),
+            serialized,
+            verified,
+            time.time(),
+        )
+        with self.lock:
+            self.db.execute('INSERT OR REPLACE INTO domains VALUES (?, ?, ?, ?, ?, ?, ?)', row)
+
+    def invalidate(self, name: str) -> None:
+        '''Forget the stored state of a domain, so that it is listed from the registrar next time'''
+        with self.lock:
+            self.db.execute('DELETE FROM domains WHERE name = ?', (name,))
+
+    def prune(self, names: Iterable[str]) -> None:
+        '''Forget the stored state of every domain not among the given domains'''
+        names = set(names)
+        with self.lock:
+            stored = [row[0] for row in self.db.execute('SELECT name FROM domains')]
+            self.db.executemany('DELETE FROM domains WHERE name = ?', [(name,) for name in stored if name not in names])
@@ -0,0 +1,80 @@
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import Callable, Optional
+from namectl.config import DomainConfig
+
+LOG = logging.getLogger('namectl')
+
+class DomainLogger(logging.LoggerAdapter):
+    '''
+    Logger adapter that prefixes every message with the domain it concerns, so that log lines stay
+    attributable when several domains are reconciled at the same time
+    '''
+    def process(self, msg, kwargs):
+        return f'[{self.extra["domain"]}] {msg}', kwargs
+
+def domain_logger(domain: str) -> DomainLogger:
+    '''Get a logger whose messages are attributed to the given domain'''
+    return DomainLogger(LOG, {'domain': domain})
+
+def reconcile_concurrently(
+    domains: list[DomainConfig],
+    reconcile: Callable[[DomainConfig], None],
+    max_workers: int = 1,
+    account_workers: Optional[int] = None,
+) -> dict[str, Exception]:
+    '''
+    Run `reconcile` for every domain on a pool of at most `max_workers` threads.
+
+    At most `account_workers` domains belonging to the same account are reconciled at once, unless
+    the account itself sets `concurrency`. Domains are only handed to the pool once their account has
+    a free slot, so a busy account never occupies workers that could serve other accounts.
+
+    Failures are isolated per domain. Returns a mapping of domain name to the exception raised while
+    reconciling it, for every domain that failed.
+    '''
+    max_workers = max(1, max_workers)
+
+    def account_limit(domain: DomainConfig) -> int:
+        limit = domain.account.concurrency or account_workers or max_workers
+        return max(1, limit)
+
+    # Queue up the domains per account, keeping the configured order within each account
+    pending: dict[str, deque[DomainConfig]] = {}
+    for domain in domains:
+        pending.setdefault(domain.account.name, deque()).append(domain)
+    running = {account: 0 for account in pending}
+
+    errors = {}
+    futures: dict[Future, DomainConfig] = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='namectl') as pool:
+        while pending or futures:
+            # Hand out work round-robin across accounts so no single account hogs the pool
+            submitted = True
+            while submitted and len(futures) < max_workers:
+                submitted = False
+                for account in list(pending):
+                    if len(futures) >= max_workers:
+                        break
+
+                    queue = pending[account]
+                    if running[account] >= account_limit(queue[0]):
+                        continue
+
+                    domain = queue.popleft()
+                    futures[pool.submit(reconcile, domain)] = domain
+                    running[account] += 1
+                    submitted = True
+                    if not queue:
+                        del pending[account]
+
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                domain = futures.pop(future)
+                running[domain.account.name] -= 1
+                error = future.exception()
+                if error is not None:
+                    errors[domain.name] = error
+
+    return errors